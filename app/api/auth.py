@@ -7,57 +7,57 @@ from app.services.auth_service import (
     signup_user, send_otp, verify_otp_token, 
     send_forgot_password_otp, change_password, reset_password_with_otp
 )
-from app.core.security import verify_token
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
+from app.api.deps import get_user_id
+from app.core.hashing import PasswordHasherBusy
 
-auth_scheme = HTTPBearer()
 router = APIRouter()
 
-def get_user_id(credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)) -> int:
-    token = credentials.credentials
-    payload = verify_token(token)
-    if payload is None:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return int(payload["sub"])
-
 @router.post("/signup")
-def signup(payload: SignupRequest):
+async def signup(payload: SignupRequest, db: AsyncSession = Depends(get_async_db)):
     try:
-        return signup_user(payload.mobile_number, payload.password)
+        return await signup_user(db, payload.mobile_number, payload.password)
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/send-otp")
-def send_otp_api(payload: SendOtpRequest):
+async def send_otp_api(payload: SendOtpRequest, db: AsyncSession = Depends(get_async_db)):
     try:
-        return send_otp(payload.mobile_number)
+        return await send_otp(db, payload.mobile_number)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/verify-otp", response_model=AuthTokenResponse)
-def verify(payload: VerifyOtpRequest):
-    token = verify_otp_token(payload.mobile_number, payload.otp)
+async def verify(payload: VerifyOtpRequest, db: AsyncSession = Depends(get_async_db)):
+    token = await verify_otp_token(db, payload.mobile_number, payload.otp)
     if not token:
         raise HTTPException(status_code=401, detail="Invalid OTP")
     return {"access_token": token, "token_type": "bearer"}
 
 @router.post("/forgot-password")
-def forgot_password(payload: ForgotPasswordRequest):
+async def forgot_password(payload: ForgotPasswordRequest, db: AsyncSession = Depends(get_async_db)):
     try:
-        return send_forgot_password_otp(payload.mobile_number)
+        return await send_forgot_password_otp(db, payload.mobile_number)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/change-password")
-def change_password_api(payload: ChangePasswordRequest, user_id: int = Depends(get_user_id)):
+async def change_password_api(payload: ChangePasswordRequest, user_id: int = Depends(get_user_id), db: AsyncSession = Depends(get_async_db)):
     try:
-        return change_password(user_id, payload.old_password, payload.new_password)
+        return await change_password(db, user_id, payload.old_password, payload.new_password)
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/reset-password")
-def reset_password(payload: VerifyOtpRequest, new_password: str):
+async def reset_password(payload: VerifyOtpRequest, new_password: str, db: AsyncSession = Depends(get_async_db)):
     try:
-        return reset_password_with_otp(payload.mobile_number, payload.otp, new_password)
+        return await reset_password_with_otp(db, payload.mobile_number, payload.otp, new_password)
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,33 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
 from app.schemas.chatroom import ChatroomCreate, ChatroomOut, ChatroomDetail
-from app.services.chatroom_service import create_chatroom, get_user_chatrooms, get_chatroom_detail
-from app.core.security import verify_token
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from app.schemas.message import MessagePage
+from app.services.chatroom_service import create_chatroom, get_user_chatrooms, get_chatroom_detail, get_messages_page
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
+from app.api.deps import get_user_id
 
-auth_scheme = HTTPBearer()
 router = APIRouter()
 
-def get_user_id(credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)) -> int:
-    token = credentials.credentials
-    payload = verify_token(token)
-    if payload is None:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return int(payload["sub"])
-
 @router.post("/", response_model=ChatroomOut)
-def create_new_chatroom(payload: ChatroomCreate, user_id: int = Depends(get_user_id)):
+async def create_new_chatroom(payload: ChatroomCreate, user_id: int = Depends(get_user_id), db: AsyncSession = Depends(get_async_db)):
     try:
-        return create_chatroom(user_id, payload)
+        return await create_chatroom(db, user_id, payload)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/", response_model=list[ChatroomOut])
-def list_chatrooms(user_id: int = Depends(get_user_id)):
-    return get_user_chatrooms(user_id)
+async def list_chatrooms(user_id: int = Depends(get_user_id), db: AsyncSession = Depends(get_async_db)):
+    return await get_user_chatrooms(db, user_id)
 
 @router.get("/{chatroom_id}", response_model=ChatroomDetail)
-def get_chatroom(chatroom_id: int, user_id: int = Depends(get_user_id)):
+async def get_chatroom(chatroom_id: int, limit: int = Query(50, ge=1, le=200), user_id: int = Depends(get_user_id), db: AsyncSession = Depends(get_async_db)):
     try:
-        return get_chatroom_detail(user_id, chatroom_id)
+        return await get_chatroom_detail(db, user_id, chatroom_id, limit)
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/{chatroom_id}/messages", response_model=MessagePage)
+async def list_messages(
+    chatroom_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user_id: int = Depends(get_user_id),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Keyset-paginated message history; `before` pages back, `after` pages forward"""
+    try:
+        return await get_messages_page(db, user_id, chatroom_id, before, after, limit)
+    except Exception as e:
+        if "Chatroom not found" in str(e):
+            raise HTTPException(status_code=404, detail=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
@@ -0,0 +1,37 @@
+from typing import Optional
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core import profiling
+from app.core.security import AuthContext, verify_token_cached
+from app.database import get_async_db
+from app.services.tier_service import get_user_tier
+
+auth_scheme = HTTPBearer()
+
+async def resolve_auth_context(db: AsyncSession, token: str) -> Optional[AuthContext]:
+    """AuthContext for a bearer token, or None if it is invalid; normally no JWT decode and no DB query"""
+    payload = verify_token_cached(token)
+    if payload is None:
+        return None
+
+    user_id = int(payload["sub"])
+    tier = await get_user_tier(db, user_id)
+    if tier is None:
+        return None
+    # Tokens are only issued after OTP verification
+    return AuthContext(user_id=user_id, tier=tier, is_verified=payload.get("verified", True))
+
+async def get_auth_context(
+    credentials: HTTPAuthorizationCredentials = Depends(auth_scheme),
+    db: AsyncSession = Depends(get_async_db)
+) -> AuthContext:
+    """Resolve the caller once per request"""
+    with profiling.timed("auth"):
+        auth = await resolve_auth_context(db, credentials.credentials)
+    if auth is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return auth
+
+async def get_user_id(auth: AuthContext = Depends(get_auth_context)) -> int:
+    return auth.user_id
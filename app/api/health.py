@@ -0,0 +1,54 @@
+import logging
+from fastapi import APIRouter
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from app.cache.gemini_cache import get_cache_stats
+from app.cache.layered_cache import cache_stats
+from app.core import metrics
+from app.database import pool_status, record_pool_gauges
+from app.workers.fair_queue import queue_depths
+from app.workers.tasks import broker_queue_depths
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@router.get("/health/stats")
+async def stats():
+    """In-process metrics and pool occupancy for this API process, plus cluster-wide Gemini cache stats"""
+    return {
+        "db_pool": pool_status(),
+        "gemini_cache": await run_in_threadpool(get_cache_stats),
+        "cache": cache_stats(),
+        **metrics.snapshot()
+    }
+
+def _record_queue_gauges():
+    try:
+        broker_depths = broker_queue_depths()
+    except Exception:
+        # Still serve everything else; a stale depth would look like a real one
+        metrics.incr("metrics.broker_depth_errors")
+        logger.warning("Could not read Celery queue depths", exc_info=True)
+        metrics.clear_gauges("celery.queue.depth")
+    else:
+        for queue, depth in broker_depths.items():
+            metrics.set_gauge(metrics.labeled("celery.queue.depth", queue=queue), depth)
+    depths = queue_depths()
+    for tier, waiting in depths["waiting_users"].items():
+        metrics.set_gauge(metrics.labeled("fairq.waiting_users", tier=tier), waiting)
+    metrics.set_gauge("fairq.inflight", depths["inflight"])
+
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """
+    Prometheus scrape endpoint: this process's metrics plus cluster-wide queue depths
+    Each API process keeps its own registry, so scrape every process (or run one worker per container)
+    """
+    record_pool_gauges()
+    await run_in_threadpool(_record_queue_gauges)
+    return Response(metrics.render_prometheus(), media_type=metrics.CONTENT_TYPE)
@@ -1,27 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
 from app.schemas.message import MessageRequest, MessageResponse
-from app.services.chatroom_service import add_user_message_and_queue
-from app.core.security import verify_token
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
+from app.services.context_service import build_context_async
+from app.services.chatroom_service import add_user_message_and_queue, add_user_message, stream_gemini_reply
+from app.services.rate_limit_service import RateLimitExceeded, rate_limit_headers
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
+from app.api.deps import get_auth_context
+from app.cache.idempotency import IdempotencyInProgress, IdempotencyKeyReused, request_fingerprint, run_once
+from app.core.security import AuthContext
 
-auth_scheme = HTTPBearer()
 router = APIRouter()
 
-def get_user_id(credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)) -> int:
-    token = credentials.credentials
-    payload = verify_token(token)
-    if payload is None:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return int(payload["sub"])
-
 @router.post("/{chatroom_id}/message", response_model=dict)
-def send_message(chatroom_id: int, payload: MessageRequest, user_id: int = Depends(get_user_id)):
+async def send_message(
+    chatroom_id: int,
+    payload: MessageRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    auth: AuthContext = Depends(get_auth_context),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Store the message and queue Gemini's reply
+    A retry with the same Idempotency-Key gets the first response back without storing,
+    charging or queueing anything again
+    """
+    async def send() -> dict:
+        result, quota = await add_user_message_and_queue(db, auth, chatroom_id, payload.content)
+        return {"body": result, "headers": rate_limit_headers(quota)}
+
     try:
-        return add_user_message_and_queue(user_id, chatroom_id, payload.content)
+        if idempotency_key:
+            sent, replayed = await run_once(
+                f"message:{auth.user_id}", idempotency_key, request_fingerprint(chatroom_id, payload.content), send
+            )
+            response.headers["Idempotent-Replayed"] = "true" if replayed else "false"
+        else:
+            sent = await send()
+    except RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=rate_limit_headers(e.quota))
+    except IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
-        if "Daily message limit exceeded" in str(e):
-            raise HTTPException(status_code=429, detail=str(e))
-        elif "Chatroom not found" in str(e):
+        if "Chatroom not found" in str(e):
             raise HTTPException(status_code=404, detail=str(e))
         else:
             raise HTTPException(status_code=400, detail=str(e))
+
+    response.headers.update(sent["headers"])
+    return sent["body"]
+
+@router.post("/{chatroom_id}/message/stream")
+async def send_message_stream(chatroom_id: int, payload: MessageRequest, auth: AuthContext = Depends(get_auth_context), db: AsyncSession = Depends(get_async_db)):
+    """Send a message and stream Gemini's reply back as Server-Sent Events"""
+    try:
+        msg, quota = await add_user_message(db, auth, chatroom_id, payload.content)
+    except RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=rate_limit_headers(e.quota))
+    except Exception as e:
+        if "Chatroom not found" in str(e):
+            raise HTTPException(status_code=404, detail=str(e))
+        else:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Assemble the conversation while the request session is still open
+    context = await build_context_async(db, chatroom_id, payload.content, msg.id)
+    return StreamingResponse(
+        stream_gemini_reply(chatroom_id, msg.id, payload.content, context),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **rate_limit_headers(quota)}
+    )
\ No newline at end of file
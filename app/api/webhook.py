@@ -8,6 +8,6 @@ async def stripe_webhook(request: Request):
     try:
         payload = await request.body()
         sig_header = request.headers.get("stripe-signature")
-        return handle_stripe_webhook(payload, sig_header)
+        return await handle_stripe_webhook(payload, sig_header)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) 
\ No newline at end of file
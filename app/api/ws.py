@@ -0,0 +1,21 @@
+from fastapi import APIRouter, WebSocket, Query
+from app.api.deps import resolve_auth_context
+from app.database import AsyncSessionLocal
+from app.services.chatroom_service import can_access_chatroom
+from app.services.realtime_service import serve_chatroom_socket
+
+router = APIRouter()
+
+@router.websocket("/ws/chatroom/{chatroom_id}")
+async def chatroom_socket(websocket: WebSocket, chatroom_id: int, token: str = Query(...)):
+    """New messages of a chatroom (user messages and bot replies) as they are stored"""
+    # Short-lived session: a socket must not hold a pooled connection for its lifetime
+    async with AsyncSessionLocal() as db:
+        auth = await resolve_auth_context(db, token)
+        allowed = auth is not None and await can_access_chatroom(db, auth.user_id, chatroom_id)
+    if not allowed:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    await serve_chatroom_socket(websocket, chatroom_id)
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import re
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+from app.cache.redis_cache import r, async_r
+from app.core import metrics
+from app.core.config import settings
+
+LRU_KEY = "gemini_cache:lru"
+STATS_KEY = "gemini_cache:stats"
+
+# Delete the lock only if we still own it
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RELEASE_LOCK = r.register_script(_RELEASE_LOCK_SCRIPT)
+_RELEASE_LOCK_ASYNC = async_r.register_script(_RELEASE_LOCK_SCRIPT)
+
+# How often a waiting caller looks for the leader's reply
+LOCK_POLL_INTERVAL = 0.05
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt).strip().casefold()
+
+def make_cache_key(prompt: str, model: str, context_hash: str = "") -> str:
+    digest = hashlib.sha256(f"{model}\0{context_hash}\0{normalize_prompt(prompt)}".encode()).hexdigest()
+    return f"gemini_cache:{digest}"
+
+def _record(stat: str):
+    metrics.incr(f"gemini.cache.{stat}")
+    r.hincrby(STATS_KEY, stat, 1)
+
+def _queue_store(pipe, key: str, value: str):
+    """Queue the write and LRU bookkeeping; the pipeline's last result is the LRU size"""
+    now = time.time()
+    pipe.set(key, value, ex=settings.GEMINI_CACHE_TTL)
+    pipe.zadd(LRU_KEY, {key: now})
+    # Entries untouched for a whole TTL have expired already
+    pipe.zremrangebyscore(LRU_KEY, "-inf", now - settings.GEMINI_CACHE_TTL)
+    pipe.zcard(LRU_KEY)
+
+def _lock_options() -> dict:
+    """SET arguments for the fill lock; it expires in case its holder dies"""
+    return {"nx": True, "px": int(settings.GEMINI_CACHE_LOCK_TIMEOUT * 1000)}
+
+def _wait_outcome(cached: Optional[str], deadline: float) -> Optional[str]:
+    """
+    Decide after each poll while another caller holds the lock: "coalesced" once
+    its reply has landed, "wait_timeouts" when we should compute it ourselves,
+    None to keep waiting
+    """
+    if cached is not None:
+        return "coalesced"
+    if time.monotonic() > deadline:
+        return "wait_timeouts"
+    return None
+
+def _store(key: str, value: str):
+    pipe = r.pipeline()
+    _queue_store(pipe, key, value)
+    size = pipe.execute()[-1]
+
+    overflow = size - settings.GEMINI_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = [k for k, _ in r.zpopmin(LRU_KEY, overflow)]
+        if evicted:
+            r.delete(*evicted)
+            metrics.incr("gemini.cache.evicted", len(evicted))
+
+def _get(key: str):
+    value = r.get(key)
+    if value is not None:
+        r.zadd(LRU_KEY, {key: time.time()})
+        return value.decode()
+    return None
+
+def get_or_compute(
+    prompt: str,
+    compute: Callable[[], str],
+    model: str,
+    context_hash: str = "",
+    cacheable: Callable[[str], bool] = lambda value: True,
+) -> str:
+    """
+    Return the cached reply for this prompt, or compute it once across all workers
+    Concurrent callers with the same key wait for the first one instead of calling Gemini
+    """
+    if not settings.GEMINI_CACHE_ENABLED:
+        return compute()
+
+    key = make_cache_key(prompt, model, context_hash)
+    cached = _get(key)
+    if cached is not None:
+        _record("hits")
+        return cached
+
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.GEMINI_CACHE_WAIT_TIMEOUT
+    while not r.set(lock_key, token, **_lock_options()):
+        # Someone else is computing this reply, wait for it to land
+        time.sleep(LOCK_POLL_INTERVAL)
+        cached = _get(key)
+        outcome = _wait_outcome(cached, deadline)
+        if outcome:
+            _record(outcome)
+            return cached if cached is not None else compute()
+
+    try:
+        # The leader may have finished between our read and the lock
+        cached = _get(key)
+        if cached is not None:
+            _record("hits")
+            return cached
+
+        _record("misses")
+        value = compute()
+        if cacheable(value):
+            _store(key, value)
+        return value
+    finally:
+        _RELEASE_LOCK(keys=[lock_key], args=[token])
+
+# The same cache for the asyncio worker; entries are shared with the sync path
+
+async def _record_async(stat: str):
+    metrics.incr(f"gemini.cache.{stat}")
+    await async_r.hincrby(STATS_KEY, stat, 1)
+
+async def _store_async(key: str, value: str):
+    pipe = async_r.pipeline()
+    _queue_store(pipe, key, value)
+    size = (await pipe.execute())[-1]
+
+    overflow = size - settings.GEMINI_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = [k for k, _ in await async_r.zpopmin(LRU_KEY, overflow)]
+        if evicted:
+            await async_r.delete(*evicted)
+            metrics.incr("gemini.cache.evicted", len(evicted))
+
+async def _get_async(key: str):
+    value = await async_r.get(key)
+    if value is not None:
+        await async_r.zadd(LRU_KEY, {key: time.time()})
+        return value.decode()
+    return None
+
+async def get_or_compute_async(
+    prompt: str,
+    compute: Callable[[], Awaitable[str]],
+    model: str,
+    context_hash: str = "",
+    cacheable: Callable[[str], bool] = lambda value: True,
+) -> str:
+    """get_or_compute on the event loop: `compute` is awaited and waiting for another worker doesn't block"""
+    if not settings.GEMINI_CACHE_ENABLED:
+        return await compute()
+
+    key = make_cache_key(prompt, model, context_hash)
+    cached = await _get_async(key)
+    if cached is not None:
+        await _record_async("hits")
+        return cached
+
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.GEMINI_CACHE_WAIT_TIMEOUT
+    while not await async_r.set(lock_key, token, **_lock_options()):
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        cached = await _get_async(key)
+        outcome = _wait_outcome(cached, deadline)
+        if outcome:
+            await _record_async(outcome)
+            return cached if cached is not None else await compute()
+
+    try:
+        cached = await _get_async(key)
+        if cached is not None:
+            await _record_async("hits")
+            return cached
+
+        await _record_async("misses")
+        value = await compute()
+        if cacheable(value):
+            await _store_async(key, value)
+        return value
+    finally:
+        await _RELEASE_LOCK_ASYNC(keys=[lock_key], args=[token])
+
+def get_cache_stats() -> dict:
+    """Cluster-wide hit/miss counters and current size"""
+    stats = {k.decode(): int(v) for k, v in r.hgetall(STATS_KEY).items()}
+    lookups = stats.get("hits", 0) + stats.get("coalesced", 0) + stats.get("misses", 0)
+    stats["hit_ratio"] = (stats.get("hits", 0) + stats.get("coalesced", 0)) / lookups if lookups else 0.0
+    stats["entries"] = r.zcard(LRU_KEY)
+    return stats
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from typing import Awaitable, Callable
+from app.cache.redis_cache import async_r, default_serializer
+from app.core import metrics
+from app.core.config import settings
+
+class IdempotencyKeyReused(Exception):
+    """The key was already used for a request with a different body"""
+
+class IdempotencyInProgress(Exception):
+    """The first request with this key is still running after IDEMPOTENCY_WAIT_TIMEOUT"""
+
+# ARGV: request fingerprint, owner token, seconds the claim is held
+# Returns {"claimed"}, {"done", response}, {"pending"} or {"mismatch"}
+_BEGIN = async_r.register_script("""
+local record = redis.call('HMGET', KEYS[1], 'fingerprint', 'response')
+if not record[1] then
+    redis.call('HSET', KEYS[1], 'fingerprint', ARGV[1], 'owner', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return {'claimed'}
+end
+if record[1] ~= ARGV[1] then
+    return {'mismatch'}
+end
+if record[2] then
+    return {'done', record[2]}
+end
+return {'pending'}
+""")
+
+# ARGV: owner token, response, ttl. Stored only if the claim is still ours
+_COMPLETE = async_r.register_script("""
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'response', ARGV[2])
+redis.call('HDEL', KEYS[1], 'owner')
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+""")
+
+# Drop a claim whose request failed, so a retry runs it again
+_RELEASE = async_r.register_script("""
+if redis.call('HGET', KEYS[1], 'owner') == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+def idempotency_key(scope: str, key: str) -> str:
+    return f"idem:{scope}:{key}"
+
+def request_fingerprint(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=default_serializer).encode()).hexdigest()
+
+async def run_once(scope: str, key: str, fingerprint: str, operation: Callable[[], Awaitable[dict]]) -> tuple:
+    """
+    Run `operation` once per (scope, key) and store its JSON result for IDEMPOTENCY_TTL
+    Returns (result, replayed). A duplicate waits for the first request and gets
+    its result; if the first one fails the claim is dropped and the next caller runs it
+    """
+    record = idempotency_key(scope, key)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        state = await _BEGIN(keys=[record], args=[fingerprint, token, int(settings.IDEMPOTENCY_LOCK_TIMEOUT)])
+        outcome = state[0].decode()
+        if outcome == "claimed":
+            break
+        if outcome == "done":
+            metrics.incr("idempotency.replayed")
+            return json.loads(state[1]), True
+        if outcome == "mismatch":
+            metrics.incr("idempotency.mismatches")
+            raise IdempotencyKeyReused("Idempotency-Key was already used with a different request")
+        if time.monotonic() > deadline:
+            metrics.incr("idempotency.wait_timeouts")
+            raise IdempotencyInProgress("A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(0.05)
+
+    try:
+        result = await operation()
+    except BaseException:
+        await _RELEASE(keys=[record], args=[token])
+        raise
+    stored = await _COMPLETE(
+        keys=[record], args=[token, json.dumps(result, default=default_serializer), settings.IDEMPOTENCY_TTL]
+    )
+    if not stored:
+        # Ran longer than IDEMPOTENCY_LOCK_TIMEOUT and someone else took over the key
+        metrics.incr("idempotency.claims_lost")
+    metrics.incr("idempotency.executed")
+    return result, False
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from app.cache.redis_cache import async_r, default_serializer, listen
+from app.core import metrics
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional
+    msgpack = None
+
+INVALIDATION_CHANNEL = "cache_invalidations"
+
+_RELEASE_LOCK = async_r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+class JsonSerializer:
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, default=default_serializer).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+class OrjsonSerializer:
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("CACHE_SERIALIZER=orjson needs the orjson package")
+
+    def dumps(self, value) -> bytes:
+        return orjson.dumps(value, default=default_serializer)
+
+    def loads(self, data: bytes):
+        return orjson.loads(data)
+
+class MsgpackSerializer:
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("CACHE_SERIALIZER=msgpack needs the msgpack package")
+
+    def dumps(self, value) -> bytes:
+        return msgpack.packb(value, default=default_serializer)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data)
+
+SERIALIZERS = {"json": JsonSerializer, "orjson": OrjsonSerializer, "msgpack": MsgpackSerializer}
+
+def get_serializer(name: str):
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown cache serializer: {name}")
+    return SERIALIZERS[name]()
+
+class LocalLRU:
+    """In-process L1: serialized values with their own expiry, least recently used evicted first"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: str, data: bytes, ttl: float):
+        if ttl <= 0:
+            return
+        self._data[key] = (data, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+# Shared by every family in this process; keys carry the family prefix
+_local = LocalLRU(settings.CACHE_L1_MAX_ENTRIES)
+_families = {}
+
+def tag_key(tag: str) -> str:
+    return f"cache_tag:{tag}"
+
+class CacheFamily:
+    """
+    One kind of cached value (e.g. a user's chatroom list), stored in L1 and in Redis
+
+    A hot key is recomputed slightly before it expires by one lucky caller
+    (probabilistic early refresh), while everyone else keeps getting the
+    current value. A cold miss is loaded by whoever takes the Redis lock;
+    other processes wait for its result instead of all hitting the database.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: int,
+        l1_ttl: Optional[float] = None,
+        serializer: Optional[str] = None,
+        early_refresh_beta: Optional[float] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.l1_ttl = min(ttl, settings.CACHE_L1_TTL if l1_ttl is None else l1_ttl)
+        self.serializer = get_serializer(serializer or settings.CACHE_SERIALIZER)
+        self.beta = settings.CACHE_EARLY_REFRESH_BETA if early_refresh_beta is None else early_refresh_beta
+        self._inflight = {}
+        _families[name] = self
+
+    def key(self, parts) -> str:
+        if isinstance(parts, tuple):
+            parts = ":".join(str(p) for p in parts)
+        return f"cache:{self.name}:{parts}"
+
+    def _record(self, stat: str):
+        metrics.incr(f"cache.{self.name}.{stat}")
+
+    def _refresh_early(self, delta: float, expires_at: float) -> bool:
+        # XFetch: the closer to expiry and the slower the load, the likelier a refresh
+        return time.time() - delta * self.beta * math.log(1.0 - random.random()) >= expires_at
+
+    async def get_or_load(self, parts, loader: Callable[[], Awaitable[Any]], tags: Iterable[str] = ()):
+        """Cached value for `parts`, calling `loader` (and storing its result) on a miss"""
+        key = self.key(parts)
+        data = _local.get(key)
+        if data is not None:
+            self._record("l1_hits")
+            return self.serializer.loads(data)
+
+        data, delta, expires_at = await async_r.hmget(key, "v", "d", "e")
+        if data is not None:
+            expires_at = float(expires_at)
+            if not self._refresh_early(float(delta), expires_at):
+                self._record("l2_hits")
+                _local.set(key, data, min(self.l1_ttl, expires_at - time.time()))
+                return self.serializer.loads(data)
+            return self.serializer.loads(await self._load(key, loader, tags, stale=data))
+
+        return self.serializer.loads(await self._load(key, loader, tags))
+
+    async def _load(self, key: str, loader, tags, stale: Optional[bytes] = None) -> bytes:
+        # Coroutines in this process share one load per key
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            if stale is not None:
+                self._record("l2_hits")
+                return stale
+            await asyncio.wait([inflight])
+            if not inflight.cancelled():
+                self._record("coalesced")
+                return inflight.result()
+
+        self._record("misses" if stale is None else "early_refreshes")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await self._load_locked(key, loader, tags, stale)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't warn if there are none
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(data)
+            return data
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _load_locked(self, key: str, loader, tags, stale: Optional[bytes]) -> bytes:
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT
+        waited = False
+        while not await async_r.set(lock_key, token, nx=True, px=int(settings.CACHE_LOCK_TIMEOUT * 1000)):
+            if stale is not None:
+                # Another process is already refreshing this key
+                return stale
+            # Wait for the holder's value; if its loader failed the lock is free
+            # again and the next attempt takes it over
+            waited = True
+            await asyncio.sleep(0.05)
+            data = await async_r.hget(key, "v")
+            if data is not None:
+                self._record("coalesced")
+                return data
+            if time.monotonic() > deadline:
+                self._record("lock_timeouts")
+                return self.serializer.dumps(await loader())
+
+        try:
+            if waited:
+                # The holder may have stored the value between our read and the lock
+                data = await async_r.hget(key, "v")
+                if data is not None:
+                    self._record("coalesced")
+                    return data
+            started = time.monotonic()
+            data = self.serializer.dumps(await loader())
+            await self._store(key, data, time.monotonic() - started, tags)
+            return data
+        finally:
+            await _RELEASE_LOCK(keys=[lock_key], args=[token])
+
+    async def _store(self, key: str, data: bytes, delta: float, tags: Iterable[str]):
+        pipe = async_r.pipeline()
+        pipe.hset(key, mapping={"v": data, "d": delta, "e": time.time() + self.ttl})
+        pipe.expire(key, self.ttl)
+        for tag in tags:
+            pipe.sadd(tag_key(tag), key)
+            # A tag set lives as long as its newest member
+            pipe.expire(tag_key(tag), self.ttl)
+        await pipe.execute()
+        _local.set(key, data, self.l1_ttl)
+
+    async def invalidate(self, *parts):
+        await invalidate_keys([self.key(p) for p in parts])
+
+    def cached(self, key: Callable[..., Any], tags: Optional[Callable[..., Iterable[str]]] = None):
+        """
+        Decorate an async function; `key` and `tags` receive the same arguments
+        and return the cache key parts and the tags for that call
+        """
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await self.get_or_load(
+                    key(*args, **kwargs),
+                    lambda: func(*args, **kwargs),
+                    tags(*args, **kwargs) if tags else (),
+                )
+            wrapper.uncached = func
+            return wrapper
+        return decorator
+
+async def invalidate_keys(keys: list):
+    """Drop keys from Redis and from L1 in every API process"""
+    if not keys:
+        return
+    await async_r.delete(*keys)
+    for key in keys:
+        _local.pop(key)
+    await async_r.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+
+async def invalidate_tags(*tags: str):
+    """Drop every key stored with any of these tags"""
+    if not tags:
+        return
+    keys = []
+    for tag in tags:
+        keys.extend(k.decode() for k in await async_r.smembers(tag_key(tag)))
+    await async_r.delete(*[tag_key(tag) for tag in tags])
+    await invalidate_keys(keys)
+
+def _on_invalidation(data: bytes):
+    for key in json.loads(data):
+        _local.pop(key)
+
+async def listen_for_invalidations():
+    """Background task: apply other processes' invalidations to this process' L1"""
+    await listen(INVALIDATION_CHANNEL, _on_invalidation, on_subscribe=_local.clear)
+
+def cache_stats() -> dict:
+    """Per-family hit ratios for this process"""
+    counters = metrics.snapshot()["counters"]
+    stats = {}
+    for name in _families:
+        family = {
+            stat: int(counters.get(f"cache.{name}.{stat}", 0))
+            for stat in ("l1_hits", "l2_hits", "misses", "early_refreshes", "coalesced", "lock_timeouts")
+        }
+        hits = family["l1_hits"] + family["l2_hits"] + family["coalesced"]
+        lookups = hits + family["misses"] + family["early_refreshes"]
+        family["hit_ratio"] = hits / lookups if lookups else 0.0
+        stats[name] = family
+    return stats
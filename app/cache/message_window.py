@@ -0,0 +1,91 @@
+import json
+from typing import Iterable, List, Optional
+from app.cache.redis_cache import r, async_r, default_serializer
+from app.core import metrics
+from app.core.config import settings
+
+# Sorted set member marking a window that was filled from the DB. Scored +inf
+# so it always ranks first when reading newest-first and survives trimming.
+LOADED = b"loaded"
+
+# ARGV: window size, ttl, then score/member pairs
+_APPEND_SCRIPT = """
+for i = 3, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[1]) + 2))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+_append = r.register_script(_APPEND_SCRIPT)
+_append_async = async_r.register_script(_APPEND_SCRIPT)
+
+def window_key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:recent"
+
+def chatroom_channel(chatroom_id: int) -> str:
+    """Pub/sub channel carrying every new message of a chatroom (see app.services.realtime_service)"""
+    return f"chatroom:{chatroom_id}:events"
+
+def serialize_message(message_id: int, sender: str, content: str, created_at) -> str:
+    return json.dumps(
+        {"id": message_id, "sender": sender, "content": content, "created_at": created_at},
+        default=default_serializer
+    )
+
+def _args(messages: Iterable[tuple]) -> list:
+    """(id, sender, content, created_at) tuples -> script arguments, scored by id"""
+    args = [settings.CHATROOM_WINDOW_SIZE, settings.CHATROOM_WINDOW_TTL]
+    for message in messages:
+        args.extend([message[0], serialize_message(*message)])
+    return args
+
+def _queue_publish(pipe, chatroom_id: int, args: list):
+    # Connected WebSockets get the same JSON that goes into the window
+    for member in args[3::2]:
+        pipe.publish(chatroom_channel(chatroom_id), member)
+
+def append_messages(rooms: dict):
+    """
+    Add freshly committed messages, {chatroom_id: [message tuples]}, to their
+    windows and announce them to listeners (Celery workers)
+    """
+    pipe = r.pipeline()
+    for chatroom_id, messages in rooms.items():
+        args = _args(messages)
+        _append(keys=[window_key(chatroom_id)], args=args, client=pipe)
+        _queue_publish(pipe, chatroom_id, args)
+    pipe.execute()
+
+async def append_messages_async(chatroom_id: int, messages: List[tuple]):
+    pipe = async_r.pipeline()
+    args = _args(messages)
+    # The asyncio script object only queues the EVALSHA once awaited
+    await _append_async(keys=[window_key(chatroom_id)], args=args, client=pipe)
+    _queue_publish(pipe, chatroom_id, args)
+    await pipe.execute()
+
+async def fill_window(chatroom_id: int, messages: List[tuple]):
+    """
+    Merge the newest messages read from the DB into the window and mark it complete
+    Appends that raced with the read are kept, since both sides only add members
+    """
+    args = _args(messages) + ["+inf", LOADED]
+    await _append_async(keys=[window_key(chatroom_id)], args=args)
+
+async def read_window(chatroom_id: int, limit: int) -> Optional[tuple]:
+    """
+    The newest `limit` messages (oldest first) and whether older ones exist
+    Returns None until the window has been filled; `limit` must be below CHATROOM_WINDOW_SIZE
+    """
+    pipe = async_r.pipeline()
+    pipe.zcard(window_key(chatroom_id))
+    pipe.zrevrange(window_key(chatroom_id), 0, limit)
+    size, members = await pipe.execute()
+    if not members or members[0] != LOADED:
+        metrics.incr("chatroom_window.misses")
+        return None
+
+    count = size - 1
+    metrics.incr("chatroom_window.hits")
+    messages = [json.loads(m) for m in reversed(members[1:])]
+    return messages, count > limit
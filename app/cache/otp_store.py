@@ -0,0 +1,52 @@
+from app.cache.redis_cache import async_r
+from app.core import metrics
+from app.core.config import settings
+
+LOGIN = "login"
+PASSWORD_RESET = "reset"
+
+# Compare a code and count the attempt in one step.
+# ARGV: code, max attempts, 1 to delete the OTP on a match (one-time use)
+# Returns 1 on a match, 0 on a wrong code, -1 if there is no OTP (never sent, expired, used or locked)
+_CHECK = async_r.register_script("""
+local code = redis.call('HGET', KEYS[1], 'code')
+if not code then
+    return -1
+end
+if code == ARGV[1] then
+    if ARGV[3] == '1' then
+        redis.call('DEL', KEYS[1])
+    end
+    return 1
+end
+local attempts = redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+if attempts >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+def otp_key(purpose: str, mobile_number: str) -> str:
+    return f"otp:{purpose}:{mobile_number}"
+
+async def issue_otp(purpose: str, mobile_number: str, code: str):
+    """Store a fresh code, replacing any earlier one and its attempt count"""
+    key = otp_key(purpose, mobile_number)
+    pipe = async_r.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={"code": code, "attempts": 0})
+    pipe.expire(key, settings.OTP_TTL)
+    await pipe.execute()
+    metrics.incr(f"otp.{purpose}.issued")
+
+async def check_otp(purpose: str, mobile_number: str, code: str, consume: bool = True) -> bool:
+    """
+    True if `code` is the current OTP. A match is consumed unless `consume` is False;
+    OTP_MAX_ATTEMPTS wrong codes burn the OTP
+    """
+    result = await _CHECK(
+        keys=[otp_key(purpose, mobile_number)],
+        args=[code, settings.OTP_MAX_ATTEMPTS, 1 if consume else 0]
+    )
+    metrics.incr(f"otp.{purpose}.{'accepted' if result == 1 else 'rejected'}")
+    return result == 1
@@ -1,27 +1,48 @@
+import asyncio
 import redis
-import json
+import redis.asyncio as aioredis
+from typing import Callable, Optional
+from app.core import metrics, profiling
 from app.core.config import settings
 from datetime import datetime
 
+# Blocking client for Celery workers and scripts
 r = redis.Redis.from_url(settings.REDIS_URL)
 
-def get_cached_chatrooms(user_id: int):
-    key = f"chatrooms:{user_id}"
-    data = r.get(key)
-    if data:
-        return json.loads(data)
-    return None
+# Asyncio client for the API request path
+async_r = aioredis.Redis.from_url(settings.REDIS_URL)
+
+if settings.DEBUG_PROFILING:
+    profiling.instrument_redis(r)
+    profiling.instrument_redis(async_r)
 
 def default_serializer(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
     raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
-def set_cached_chatrooms(user_id: int, data):
-    key = f"chatrooms:{user_id}"
-    r.set(key, json.dumps(data, default=default_serializer), ex=300)  # 5 mins TTL
-
-def invalidate_chatroom_cache(user_id: int):
-    """Invalidate chatroom cache for a specific user"""
-    key = f"chatrooms:{user_id}"
-    r.delete(key)
+async def listen(
+    channel: str,
+    on_message: Callable[[bytes], None],
+    on_subscribe: Optional[Callable[[], None]] = None,
+):
+    """
+    Run `on_message` for every message published on `channel`, resubscribing after errors
+    `on_subscribe` runs on each (re)subscribe, e.g. to drop state that may have missed messages
+    """
+    while True:
+        pubsub = async_r.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            if on_subscribe:
+                on_subscribe()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    on_message(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metrics.incr(f"redis.pubsub.{channel}.errors")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
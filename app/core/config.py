@@ -1,9 +1,18 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     # Database
     DATABASE_URL: str
-    
+    ASYNC_DATABASE_URL: Optional[str] = None  # defaults to DATABASE_URL with an asyncio driver
+
+    # Connection pool (applies per engine, per process: size it against Postgres max_connections)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30  # seconds to wait for a connection
+    DB_POOL_RECYCLE: int = 1800  # seconds before a connection is replaced
+    DB_POOL_PRE_PING: bool = True
+
     # Redis
     REDIS_URL: str
     
@@ -13,14 +22,99 @@ class Settings(BaseSettings):
     
     # JWT
     JWT_SECRET: str
-    
+    AUTH_TOKEN_CACHE_SIZE: int = 10000  # verified tokens kept in memory per process
+
+    # One-time passwords, stored in Redis
+    OTP_TTL: int = 900  # seconds a code stays valid
+    OTP_MAX_ATTEMPTS: int = 5  # wrong codes before the OTP is burned
+
+    # Password hashing (bcrypt) in a dedicated process pool
+    BCRYPT_ROUNDS: int = 12  # cost factor for new hashes; stored hashes keep their own
+    PASSWORD_HASH_WORKERS: int = 2  # processes per API process
+    PASSWORD_HASH_MAX_QUEUE: int = 32  # waiting jobs before requests get a 503
+
+    # Idempotency-Key on POST /chatroom/{id}/message
+    IDEMPOTENCY_TTL: int = 86400  # seconds a stored response is replayed
+    IDEMPOTENCY_LOCK_TIMEOUT: float = 30.0  # seconds a request holds its key before a retry may take over
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 10.0  # seconds a duplicate waits for the first request before a 409
+
     # Stripe
     STRIPE_SECRET_KEY: str
     STRIPE_WEBHOOK_SECRET: str
+    STRIPE_EVENT_TTL: int = 604800  # seconds a processed event id is remembered (Stripe retries for 3 days)
     
     # Gemini
     GEMINI_API_KEY: str
     GEMINI_API_URL: str = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+    GEMINI_STREAM_API_URL: Optional[str] = None  # defaults to GEMINI_API_URL with :streamGenerateContent
+    GEMINI_CONNECT_TIMEOUT: float = 5.0
+    GEMINI_READ_TIMEOUT: float = 60.0
+    GEMINI_POOL_MAXSIZE: int = 10  # keep-alive connections per process
+    GEMINI_MAX_RETRIES: int = 3  # retries for 429/5xx and network errors
+    GEMINI_BACKOFF_BASE: float = 0.5  # seconds, doubled per attempt with full jitter
+    GEMINI_BACKOFF_MAX: float = 20.0
+    GEMINI_BREAKER_FAILURE_THRESHOLD: int = 5  # consecutive failed calls before failing fast
+    GEMINI_BREAKER_RESET_TIMEOUT: float = 30.0  # seconds before a probe call is let through
+
+    # Gemini quota shared by all workers (Redis token bucket); set these to the project's limits, 0 disables
+    GEMINI_RPM_LIMIT: int = 1000  # requests per minute
+    GEMINI_TPM_LIMIT: int = 1000000  # tokens per minute, prompt and reply
+    GEMINI_QUOTA_BURST_SECONDS: float = 10.0  # seconds of quota that can be spent at once after idling
+    GEMINI_QUOTA_REPLY_TOKENS: int = 1000  # reserved per call for the reply until Gemini reports real usage
+    GEMINI_QUOTA_MAX_WAIT: float = 5.0  # seconds a call waits for quota before the task is rescheduled
+
+    # Conversation context sent with each reply
+    GEMINI_CONTEXT_TOKEN_BUDGET: int = 4000  # estimated tokens of history, summary included
+    GEMINI_CONTEXT_MAX_MESSAGES: int = 100  # newest messages loaded per reply
+    GEMINI_SUMMARY_MAX_TOKENS: int = 500
+    GEMINI_SUMMARY_BATCH: int = 200  # messages folded into the summary per pass
+
+    # Daily user_usage rows older than this are rolled into user_usage_monthly by compact_user_usage
+    USAGE_DAILY_RETENTION_DAYS: int = 90
+
+    # Fair scheduling of Gemini replies: share of workers each tier gets while both have a backlog
+    GEMINI_TIER_WEIGHTS: str = "pro:3,basic:1"
+
+    # Asyncio Gemini worker (python -m app.workers.async_worker)
+    ASYNC_WORKER_CONCURRENCY: int = 200  # replies in flight per process
+    ASYNC_WORKER_QUEUES: Optional[str] = None  # comma-separated, defaults to every tier queue
+
+    # Celery worker write-behind buffer for bot replies
+    WORKER_WRITE_BATCH_SIZE: int = 100  # rows per INSERT
+    WORKER_WRITE_BATCH_WINDOW: float = 0.02  # seconds the oldest row may wait for company
+    WORKER_WRITE_TIMEOUT: float = 30.0  # seconds a task waits for its batch to commit
+
+    # Gemini response cache (opt-in), shared by all workers through Redis
+    GEMINI_CACHE_ENABLED: bool = False
+    GEMINI_CACHE_TTL: int = 3600  # seconds
+    GEMINI_CACHE_MAX_ENTRIES: int = 10000  # least recently used replies are evicted beyond this
+    GEMINI_CACHE_LOCK_TIMEOUT: float = 90.0  # seconds one worker may hold the compute lock
+    GEMINI_CACHE_WAIT_TIMEOUT: float = 90.0  # seconds a duplicate prompt waits for the first call
+
+    # Two-level cache for service data (app/cache/layered_cache.py)
+    CACHE_SERIALIZER: str = "json"  # json, orjson or msgpack (the latter two are optional installs)
+    CACHE_L1_TTL: float = 30.0  # seconds in process memory; invalidations are also pushed via pub/sub
+    CACHE_L1_MAX_ENTRIES: int = 10000
+    CACHE_EARLY_REFRESH_BETA: float = 1.0  # higher refreshes hot keys earlier, 0 disables
+    CACHE_LOCK_TIMEOUT: float = 10.0  # seconds one process may hold a key's recompute lock
+
+    # Newest messages of each chatroom kept in Redis for GET /chatroom/{id}
+    CHATROOM_WINDOW_SIZE: int = 201  # messages; pages of this size or more are read from the DB
+    CHATROOM_WINDOW_TTL: int = 86400  # seconds since the last write, rebuilt from the DB after that
+
+    # Subscription tier cache (process memory, then Redis); changes are pushed via pub/sub
+    TIER_CACHE_TTL: int = 86400  # seconds in Redis
+    TIER_CACHE_LOCAL_TTL: float = 30.0  # seconds in process memory, backstop for missed invalidations
+    TIER_CACHE_LOCAL_MAX_ENTRIES: int = 10000
+
+    # Debug profiling: Server-Timing header per request and logs for slow requests and repeated queries
+    DEBUG_PROFILING: bool = False
+    SLOW_REQUEST_THRESHOLD: float = 1.0  # seconds
+
+    # Observability: GET /metrics on the API; workers serve it on WORKER_METRICS_PORT when set
+    WORKER_METRICS_PORT: Optional[int] = None
+    OTEL_EXPORTER_OTLP_ENDPOINT: Optional[str] = None  # e.g. http://otel-collector:4318, spans are only exported when set
+    OTEL_SERVICE_NAME: str = "gemini-backend"  # spans are reported as {name}-api and {name}-worker
 
     model_config = {
         "env_file": ".env"
@@ -0,0 +1,72 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from app.core import metrics
+from app.core.config import settings
+from app.core.security import pwd_context
+
+class PasswordHasherBusy(Exception):
+    """Raised instead of queueing when the hashing pool already has too much work"""
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_pending = 0  # jobs running or queued in this process
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        # spawn: forking a process that runs an event loop and threads is not safe
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        _executor_pid = os.getpid()
+    return _executor
+
+def shutdown_password_pool():
+    global _executor
+    if _executor is not None and _executor_pid == os.getpid():
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+# These run in the pool's worker processes
+
+def _hash(password: str) -> tuple:
+    started = time.time()
+    return pwd_context.hash(password), started
+
+def _verify(password: str, hashed: str) -> tuple:
+    started = time.time()
+    return pwd_context.verify(password, hashed), started
+
+async def _run(operation: str, func, *args):
+    global _pending
+    if _pending >= settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_MAX_QUEUE:
+        metrics.incr("password_hash.rejected")
+        raise PasswordHasherBusy("Too many password requests right now, please retry shortly")
+
+    _pending += 1
+    metrics.set_gauge("password_hash.pending", _pending)
+    submitted = time.time()
+    try:
+        result, started = await asyncio.wrap_future(_get_executor().submit(func, *args))
+    finally:
+        _pending -= 1
+        metrics.set_gauge("password_hash.pending", _pending)
+
+    finished = time.time()
+    metrics.observe("password_hash.queue_wait", max(started - submitted, 0.0))
+    metrics.observe(f"password_hash.{operation}_time", finished - started)
+    metrics.incr(f"password_hash.{operation}")
+    return result
+
+async def hash_password(password: str) -> str:
+    """bcrypt hash at the configured cost, computed off the event loop and off the threadpool"""
+    return await _run("hash", _hash, password)
+
+async def check_password(password: str, hashed: str) -> bool:
+    """bcrypt verify against a stored hash of any cost, off the event loop and off the threadpool"""
+    return await _run("verify", _verify, password, hashed)
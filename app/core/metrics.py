@@ -0,0 +1,153 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# Simple in-process metrics registry, reported by GET /health/stats and, in
+# the Prometheus text format, by GET /metrics.
+# Names are dotted strings, e.g. "db.pool.checkouts", optionally with labels
+# (see labeled()).
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_timers = {}
+
+# Histogram bucket bounds for timers, in seconds (prometheus_client's defaults)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def labeled(name: str, **labels) -> str:
+    """Metric name with Prometheus labels, e.g. http.request.duration{method="GET",route="/user/me"}"""
+    if not labels:
+        return name
+    pairs = ",".join(f'{key}="{_escape(str(value))}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def incr(name: str, value: float = 1):
+    """Increment a counter"""
+    with _lock:
+        _counters[name] += value
+
+def set_gauge(name: str, value: float):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+def clear_gauges(name: str):
+    """Drop a gauge and all its labeled series, e.g. when its current value can't be read"""
+    with _lock:
+        for key in [key for key in _gauges if key.partition("{")[0] == name]:
+            del _gauges[key]
+
+def observe(name: str, value: float):
+    """Record one observation (seconds, sizes, ...) for a timer"""
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(BUCKETS)}
+        timer["count"] += 1
+        timer["sum"] += value
+        timer["max"] = max(timer["max"], value)
+        index = bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            timer["buckets"][index] += 1
+
+@contextmanager
+def timed(name: str):
+    """Observe the wall time spent inside the block"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def snapshot() -> dict:
+    """Return a copy of all metrics"""
+    with _lock:
+        timers = {
+            name: {
+                "count": timer["count"], "sum": timer["sum"], "max": timer["max"],
+                "avg": timer["sum"] / timer["count"] if timer["count"] else 0.0,
+            }
+            for name, timer in _timers.items()
+        }
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "timers": timers}
+
+def _split(name: str) -> tuple:
+    """("gemini_calls_success", 'tier="pro"') from a dotted, possibly labeled name"""
+    base, _, labels = name.partition("{")
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", base), labels.rstrip("}")
+
+def _series(name: str, labels: str, value: float, extra: str = "") -> str:
+    labels = ",".join(part for part in (labels, extra) if part)
+    return f"{name}{{{labels}}} {value!r}" if labels else f"{name} {value!r}"
+
+def render_prometheus() -> str:
+    """
+    All metrics in the Prometheus text format: counters get a _total suffix,
+    timers become histograms over BUCKETS
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timers = {name: dict(timer, buckets=list(timer["buckets"])) for name, timer in _timers.items()}
+
+    families = defaultdict(list)  # (name, type) -> sample lines
+    for name, value in counters.items():
+        base, labels = _split(name)
+        families[(f"{base}_total", "counter")].append(_series(f"{base}_total", labels, float(value)))
+    for name, value in gauges.items():
+        base, labels = _split(name)
+        families[(base, "gauge")].append(_series(base, labels, float(value)))
+    for name, timer in timers.items():
+        base, labels = _split(name)
+        lines = families[(base, "histogram")]
+        cumulative = 0
+        for bound, count in zip(BUCKETS, timer["buckets"]):
+            cumulative += count
+            lines.append(_series(f"{base}_bucket", labels, float(cumulative), f'le="{bound}"'))
+        lines.append(_series(f"{base}_bucket", labels, float(timer["count"]), 'le="+Inf"'))
+        lines.append(_series(f"{base}_sum", labels, timer["sum"]))
+        lines.append(_series(f"{base}_count", labels, float(timer["count"])))
+
+    output = []
+    for (name, kind), lines in sorted(families.items()):
+        output.append(f"# TYPE {name} {kind}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+def serve(port: int, collect: Optional[Callable[[], None]] = None) -> ThreadingHTTPServer:
+    """
+    Expose render_prometheus() on http://0.0.0.0:{port}/metrics from a daemon
+    thread, for processes without an HTTP server (Celery and asyncio workers)
+    `collect` runs before each scrape, e.g. to refresh gauges
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            if collect:
+                collect()
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,91 @@
+import time
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from app.core import metrics, profiling, tracing
+
+def route_template(scope) -> str:
+    """
+    Request path with its parameters put back as {name}, e.g. /chatroom/{chatroom_id}/message,
+    so series don't multiply per id; "unmatched" when no route matched
+    """
+    if "endpoint" not in scope:
+        return "unmatched"
+    names = {str(value): f"{{{name}}}" for name, value in scope.get("path_params", {}).items()}
+    return "/".join(names.get(segment, segment) for segment in scope["path"].split("/"))
+
+class RequestMetricsMiddleware:
+    """
+    Latency per route (http.request.duration{method,route,status}) and
+    a server span per request that continues the caller's trace, if it sent one
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        start = time.perf_counter()
+        with tracing.span(scope["method"], parent=headers, kind="server") as span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = route_template(scope)
+                metrics.observe(
+                    metrics.labeled("http.request.duration", method=scope["method"], route=route, status=status),
+                    time.perf_counter() - start
+                )
+                if span is not None:
+                    span.update_name(f"{scope['method']} {route}")
+                    span.set_attribute("http.request.method", scope["method"])
+                    span.set_attribute("http.route", route)
+                    span.set_attribute("http.response.status_code", status)
+
+class ProfilingMiddleware:
+    """
+    Debug mode (DEBUG_PROFILING): query count and time spent in the database,
+    Redis, auth and JSON rendering, sent back in a Server-Timing header. Slow
+    requests and requests that repeat a statement are logged with a breakdown
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = profiling.QueryProfile()
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", profiling.server_timing(profile, time.perf_counter() - start))
+            await send(message)
+
+        token = profiling.activate(profile)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            profiling.deactivate(token)
+            profiling.report(scope["method"], route_template(scope), profile, time.perf_counter() - start)
+
+class ProfiledJSONResponse(JSONResponse):
+    """JSONResponse that reports its rendering time as "serialization" under ProfilingMiddleware"""
+
+    def render(self, content) -> bytes:
+        with profiling.timed("serialization"):
+            return super().render(content)
@@ -0,0 +1,178 @@
+import inspect
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import event
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Where a request's time goes, as reported in Server-Timing. Categories can
+# overlap: auth includes the Redis and DB lookups it makes.
+CATEGORIES = ("db", "redis", "auth", "serialization")
+
+@dataclass
+class QueryProfile:
+    """Queries and time per category seen during one request or count_queries() block"""
+    queries: int = 0
+    statements: Counter = field(default_factory=Counter)
+    timings: dict = field(default_factory=lambda: dict.fromkeys(CATEGORIES, 0.0))
+
+    def repeated(self) -> list:
+        """(statement, count) for statements run more than once, most frequent first"""
+        return [(statement, count) for statement, count in self.statements.most_common() if count > 1]
+
+_current: ContextVar[Optional[QueryProfile]] = ContextVar("query_profile", default=None)
+_collectors = []  # open count_queries() blocks; they see queries from every thread
+_lock = threading.Lock()
+
+def activate(profile: QueryProfile):
+    """Attribute what runs in this context (and tasks started from it) to `profile`; returns a reset token"""
+    return _current.set(profile)
+
+def deactivate(token):
+    _current.reset(token)
+
+def add_time(category: str, seconds: float):
+    profile = _current.get()
+    if profile is not None:
+        with _lock:
+            profile.timings[category] = profile.timings.get(category, 0.0) + seconds
+
+@contextmanager
+def timed(category: str):
+    """Add the block's wall time to the current request's `category`, a no-op outside profiled requests"""
+    if _current.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(category, time.perf_counter() - start)
+
+def _record_query(statement: str, seconds: float):
+    profile = _current.get()
+    if profile is None and not _collectors:
+        return
+    with _lock:
+        targets = [profile] if profile is not None else []
+        targets += [collector for collector in _collectors if collector is not profile]
+        for target in targets:
+            target.queries += 1
+            target.statements[statement] += 1
+            target.timings["db"] += seconds
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_query(statement, time.perf_counter() - conn.info["profiling_started"].pop())
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get("profiling_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+def instrument_engine(engine):
+    """Count and time every statement run on a sync Engine (for an AsyncEngine pass .sync_engine)"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+def instrument_redis(client):
+    """
+    Time commands, scripts and pipelines sent through a redis-py client (sync or
+    asyncio) as "redis". Only installed with DEBUG_PROFILING, it costs a wrapper per call
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    if inspect.iscoroutinefunction(execute_command):
+        async def timed_execute_command(*args, **options):
+            with timed("redis"):
+                return await execute_command(*args, **options)
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def timed_execute(*execute_args, **execute_kwargs):
+                with timed("redis"):
+                    return await execute(*execute_args, **execute_kwargs)
+            pipe.execute = timed_execute
+            return pipe
+    else:
+        def timed_execute_command(*args, **options):
+            with timed("redis"):
+                return execute_command(*args, **options)
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def timed_execute(*execute_args, **execute_kwargs):
+                with timed("redis"):
+                    return execute(*execute_args, **execute_kwargs)
+            pipe.execute = timed_execute
+            return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+
+def server_timing(profile: QueryProfile, elapsed: float) -> str:
+    """Server-Timing header value, durations in milliseconds"""
+    parts = [f'db;dur={profile.timings["db"] * 1000:.1f};desc="{profile.queries} queries"']
+    parts += [f"{name};dur={profile.timings[name] * 1000:.1f}" for name in CATEGORIES[1:]]
+    parts.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(parts)
+
+def report(method: str, route: str, profile: QueryProfile, elapsed: float):
+    """Log requests slower than SLOW_REQUEST_THRESHOLD, or that ran a statement more than once"""
+    repeated = profile.repeated()
+    slow = elapsed >= settings.SLOW_REQUEST_THRESHOLD
+    if slow:
+        metrics.incr("http.requests.slow")
+    if repeated:
+        metrics.incr("http.requests.repeated_queries")
+    if not (slow or repeated):
+        return
+    lines = [
+        f"{'Slow request' if slow else 'Repeated queries in'} {method} {route}: {elapsed * 1000:.1f} ms, "
+        f"{profile.queries} queries, "
+        + ", ".join(f"{name} {profile.timings[name] * 1000:.1f} ms" for name in CATEGORIES)
+    ]
+    lines += [f"  {count}x {' '.join(statement.split())}" for statement, count in repeated]
+    logger.warning("\n".join(lines))
+
+@contextmanager
+def count_queries():
+    """Collect every query run while the block is open, in any thread (e.g. behind a TestClient)"""
+    profile = QueryProfile()
+    with _lock:
+        _collectors.append(profile)
+    try:
+        yield profile
+    finally:
+        with _lock:
+            _collectors.remove(profile)
+
+@contextmanager
+def assert_max_queries(limit: int):
+    """
+    Fail if the block runs more than `limit` queries, listing them; for catching N+1 regressions
+
+        with assert_max_queries(3):
+            client.get(f"/chatroom/{chatroom_id}", headers=headers)
+    """
+    with count_queries() as profile:
+        yield profile
+    if profile.queries > limit:
+        statements = "\n".join(f"  {count}x {' '.join(statement.split())}" for statement, count in profile.statements.most_common())
+        raise AssertionError(f"{profile.queries} queries, expected at most {limit}:\n{statements}")
@@ -1,13 +1,21 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from app.core import metrics
 from app.core.config import settings
+from app.models.user import SubscriptionTier
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing, run in a process pool by app.core.hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -23,8 +31,39 @@ def verify_token(token: str):
     except JWTError:
         return None
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+@dataclass
+class AuthContext:
+    """Who is making the request, resolved once per request by app.api.deps"""
+    user_id: int
+    tier: SubscriptionTier
+    is_verified: bool
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+# sha256(token) -> decoded claims, least recently used first
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def verify_token_cached(token: str) -> Optional[dict]:
+    """
+    verify_token with a bounded LRU of already verified tokens
+    Entries are served only until the token's own `exp`
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    with _token_cache_lock:
+        payload = _token_cache.get(key)
+        if payload is not None:
+            if payload["exp"] > time.time():
+                _token_cache.move_to_end(key)
+                metrics.incr("auth.token_cache.hits")
+                return payload
+            del _token_cache[key]
+
+    metrics.incr("auth.token_cache.misses")
+    payload = verify_token(token)
+    if payload is None or "exp" not in payload:
+        return payload
+
+    with _token_cache_lock:
+        _token_cache[key] = payload
+        while len(_token_cache) > settings.AUTH_TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return payload
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from typing import Optional
+from app.core.config import settings
+
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.trace import SpanKind
+except ImportError:  # optional
+    trace = None
+
+# Trace context travels in W3C headers (traceparent/tracestate): on HTTP
+# requests, on Celery task messages and inside fair queue jobs, so one message
+# can be followed from the API through the run token to the Gemini call.
+
+def setup(component: str):
+    """
+    Export spans over OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT when it is set.
+    Otherwise spans go to whatever tracer provider is installed (e.g. by
+    opentelemetry-instrument), and are dropped if there is none; the trace
+    context is still passed along
+    """
+    if not settings.OTEL_EXPORTER_OTLP_ENDPOINT:
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        raise RuntimeError(
+            "OTEL_EXPORTER_OTLP_ENDPOINT needs the opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages"
+        )
+    provider = TracerProvider(resource=Resource.create({"service.name": f"{settings.OTEL_SERVICE_NAME}-{component}"}))
+    provider.add_span_processor(BatchSpanProcessor(
+        OTLPSpanExporter(endpoint=f"{settings.OTEL_EXPORTER_OTLP_ENDPOINT.rstrip('/')}/v1/traces")
+    ))
+    trace.set_tracer_provider(provider)
+
+def inject() -> dict:
+    """Trace context of the current span as headers, empty without OpenTelemetry"""
+    carrier = {}
+    if trace is not None:
+        propagate.inject(carrier)
+    return carrier
+
+def fields() -> set:
+    """Header names inject() may write"""
+    return propagate.get_global_textmap().fields if trace is not None else set()
+
+@contextmanager
+def span(name: str, parent: Optional[dict] = None, kind: str = "internal", **attributes):
+    """
+    Run the block in a span, a child of the current span or of the trace context
+    in `parent` (headers from inject()). Yields the span, or None without OpenTelemetry
+    """
+    if trace is None:
+        yield None
+        return
+    context = propagate.extract(parent) if parent is not None else None
+    with trace.get_tracer("app").start_as_current_span(
+        name, context=context, kind=getattr(SpanKind, kind.upper()), attributes=attributes
+    ) as current:
+        yield current
@@ -1,20 +1,165 @@
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from app.core import metrics, profiling
 from app.core.config import settings
 from app.models.user import Base
 from app.models.chatroom import Chatroom
 from app.models.message import Message
-from app.models.subscription import Subscription, UserUsage
+from app.models.subscription import Subscription, UserUsage, UserUsageMonthly
 
-# Create engine
-engine = create_engine(settings.DATABASE_URL)
+def get_async_database_url(url: str) -> str:
+    """Map a sync DATABASE_URL onto its asyncio driver"""
+    for prefix, async_prefix in (
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgres://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+class _InstrumentedPool:
+    """Records checkout wait time, checkout count and overflow usage of a QueuePool"""
+    metrics_name = "sync"
+
+    def _do_get(self):
+        prefix = f"db.pool.{self.metrics_name}"
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except Exception:
+            metrics.incr(f"{prefix}.checkout_errors")
+            raise
+        finally:
+            metrics.observe(f"{prefix}.checkout_wait", time.perf_counter() - start)
+        metrics.incr(f"{prefix}.checkouts")
+        overflow = max(self.overflow(), 0)
+        if overflow:
+            metrics.incr(f"{prefix}.overflow_checkouts")
+        metrics.set_gauge(f"{prefix}.overflow", overflow)
+        return record
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    metrics_name = "sync"
+
+class InstrumentedAsyncQueuePool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+def _pool_options(url: str, poolclass) -> dict:
+    # In-memory SQLite needs its single shared connection, leave it alone
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    return {
+        "poolclass": poolclass,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+# Create engine (used by Celery workers and scripts)
+engine = create_engine(settings.DATABASE_URL, **_pool_options(settings.DATABASE_URL, InstrumentedQueuePool))
 
 # Create SessionLocal
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine used by the API request path
+ASYNC_DATABASE_URL = settings.ASYNC_DATABASE_URL or get_async_database_url(settings.DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_options(ASYNC_DATABASE_URL, InstrumentedAsyncQueuePool))
+
+profiling.instrument_engine(engine)
+profiling.instrument_engine(async_engine.sync_engine)
+
+# Objects stay usable after commit so routes can serialize them without lazy loads
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+def pool_status() -> dict:
+    """Current occupancy of both connection pools, for sizing against max_connections"""
+    status = {}
+    for name, pool in (("sync", engine.pool), ("async", async_engine.sync_engine.pool)):
+        if isinstance(pool, QueuePool):
+            status[name] = {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "max_overflow": pool._max_overflow,
+            }
+        else:
+            status[name] = {"status": pool.status()}
+    return status
+
+def record_pool_gauges():
+    """Copy pool_status() into gauges (db.pool.checked_out{pool="sync"}, ...) before a metrics scrape"""
+    for name, status in pool_status().items():
+        for field, value in status.items():
+            if isinstance(value, (int, float)):
+                metrics.set_gauge(metrics.labeled(f"db.pool.{field}", pool=name), value)
+
+# pg_advisory_xact_lock id held while a process creates or upgrades the schema
+SCHEMA_LOCK_ID = 7_364_201
+
+def _add_usage_day(conn):
+    """
+    Move an existing user_usage table from its `date` timestamp to `usage_day`,
+    merging the duplicate rows per user and day that the unique index forbids
+    """
+    if "user_usage" not in inspect(conn).get_table_names():
+        return
+    if "usage_day" in {column["name"] for column in inspect(conn).get_columns("user_usage")}:
+        return
+    utc_date = "date(date)" if conn.dialect.name == "sqlite" else "CAST(date AT TIME ZONE 'UTC' AS DATE)"
+    conn.execute(text("ALTER TABLE user_usage ADD COLUMN usage_day DATE"))
+    conn.execute(text(f"UPDATE user_usage SET usage_day = {utc_date}"))
+    conn.execute(text("""
+        UPDATE user_usage SET message_count = (
+            SELECT MAX(other.message_count) FROM user_usage other
+            WHERE other.user_id = user_usage.user_id AND other.usage_day = user_usage.usage_day
+        )
+    """))
+    conn.execute(text("""
+        DELETE FROM user_usage WHERE id NOT IN (
+            SELECT MIN(id) FROM user_usage GROUP BY user_id, usage_day
+        )
+    """))
+
+def _add_last_event_created(conn):
+    """subscriptions tables from before the Stripe event ordering guard lack its column"""
+    if "subscriptions" not in inspect(conn).get_table_names():
+        return
+    if "last_event_created" in {column["name"] for column in inspect(conn).get_columns("subscriptions")}:
+        return
+    conn.execute(text("ALTER TABLE subscriptions ADD COLUMN last_event_created INTEGER"))
+
+def _create_all(conn):
+    if conn.dialect.name == "postgresql":
+        # API processes start together (uvicorn --workers N): one upgrades the
+        # schema, the others wait for its commit and then find nothing to do
+        conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": SCHEMA_LOCK_ID})
+    _add_usage_day(conn)
+    _add_last_event_created(conn)
+    Base.metadata.create_all(bind=conn)
+    # Replaced by ix_messages_chatroom_id_id when pagination moved from (created_at, id) to id
+    conn.execute(text("DROP INDEX IF EXISTS ix_messages_chatroom_id_created_at_id"))
+    # create_all only adds indexes together with new tables, backfill them on existing ones
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
 def create_tables():
     """Create all database tables"""
-    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _create_all(conn)
+
+async def create_tables_async():
+    """Create all database tables using the async engine"""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(_create_all)
 
 def get_db():
     """Dependency to get database session"""
@@ -22,4 +167,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    """Dependency to get the request-scoped async database session"""
+    async with AsyncSessionLocal() as db:
+        yield db
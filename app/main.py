@@ -1,16 +1,41 @@
+import asyncio
+import logging
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from app.api import auth, user, chatroom, message, subscription, webhook
+from app.api import auth, user, chatroom, message, subscription, webhook, health, ws
+from app.core import tracing
 from app.core.config import settings
-from app.database import create_tables
+from app.core.middleware import ProfiledJSONResponse, ProfilingMiddleware, RequestMetricsMiddleware
+from app.database import create_tables_async
+from app.cache.layered_cache import listen_for_invalidations
+from app.core.hashing import shutdown_password_pool
+from app.services.realtime_service import hub
+from app.services.tier_service import listen_for_tier_changes
 
-app = FastAPI(title="Gemini Style Backend System")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="Gemini Style Backend System",
+    default_response_class=ProfiledJSONResponse if settings.DEBUG_PROFILING else JSONResponse
+)
 
 # Initialize database tables
 @app.on_event("startup")
 async def startup_event():
-    create_tables()
+    tracing.setup("api")
+    await create_tables_async()
+    app.state.listeners = [
+        asyncio.create_task(listen_for_tier_changes()),
+        asyncio.create_task(listen_for_invalidations()),
+    ]
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in app.state.listeners:
+        task.cancel()
+    await hub.close()
+    shutdown_password_pool()
 
 # CORS settings
 app.add_middleware(
@@ -20,10 +45,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if settings.DEBUG_PROFILING:
+    app.add_middleware(ProfilingMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
 
 # Global exception handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
+    logger.exception("Unhandled error in %s %s", request.method, request.url.path, exc_info=exc)
     return JSONResponse(
         status_code=500,
         content={"detail": "Internal server error"}
@@ -36,6 +65,8 @@ app.include_router(chatroom.router, prefix="/chatroom", tags=["Chatroom"])
 app.include_router(message.router, prefix="/chatroom", tags=["Message"])
 app.include_router(subscription.router, prefix="/subscription", tags=["Subscription"])
 app.include_router(webhook.router, tags=["Webhook"])
+app.include_router(health.router, tags=["Health"])
+app.include_router(ws.router, tags=["WebSocket"])
 
 @app.get("/")
 def root():
@@ -1,10 +1,18 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.models.user import Base
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination: WHERE chatroom_id = ? AND id < ? ORDER BY id. Ids give the same
+        # order as the Redis message window; created_at is the transaction start on Postgres
+        # and can run backwards relative to ids under concurrent inserts
+        Index("ix_messages_chatroom_id_id", "chatroom_id", "id"),
+    )
+    # Get created_at back from the INSERT itself; it goes into the Redis message window
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     chatroom_id = Column(Integer, ForeignKey("chatrooms.id"))
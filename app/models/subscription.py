@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Date, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.models.user import Base
@@ -13,14 +13,33 @@ class Subscription(Base):
     status = Column(String, default="active")  # active, canceled, past_due
     current_period_start = Column(DateTime(timezone=True), nullable=True)
     current_period_end = Column(DateTime(timezone=True), nullable=True)
+    last_event_created = Column(Integer, nullable=True)  # `created` (epoch seconds) of the last Stripe event applied
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
 class UserUsage(Base):
+    """Messages per user per UTC day, mirrored from the Redis quota counter"""
     __tablename__ = "user_usage"
+    __table_args__ = (
+        # One row per user and day: the target of the ON CONFLICT upsert, and the lookup index
+        Index("uq_user_usage_user_id_usage_day", "user_id", "usage_day", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    date = Column(DateTime(timezone=True), server_default=func.now())
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    usage_day = Column(Date, nullable=False)  # UTC
+    message_count = Column(Integer, default=0)
+    daily_limit = Column(Integer, default=5)  # 5 for basic, unlimited for pro
+
+class UserUsageMonthly(Base):
+    """Daily user_usage rows older than USAGE_DAILY_RETENTION_DAYS, rolled up per month"""
+    __tablename__ = "user_usage_monthly"
+    __table_args__ = (
+        Index("uq_user_usage_monthly_user_id_month", "user_id", "month", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    month = Column(Date, nullable=False)  # first day of the month
     message_count = Column(Integer, default=0)
-    daily_limit = Column(Integer, default=5)  # 5 for basic, unlimited for pro 
\ No newline at end of file
+    active_days = Column(Integer, default=0) 
\ No newline at end of file
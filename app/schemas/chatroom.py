@@ -20,3 +20,7 @@ class ChatroomDetail(BaseModel):
     name: str
     created_at: datetime
     messages: List[MessageResponse]
+    # Only the latest page of messages; older ones via GET /chatroom/{id}/messages?before=
+    has_more: bool = False
+    before_cursor: Optional[str] = None
+    after_cursor: Optional[str] = None
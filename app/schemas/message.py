@@ -1,5 +1,6 @@
 from pydantic import BaseModel, ConfigDict
 from datetime import datetime
+from typing import List, Optional
 
 class MessageRequest(BaseModel):
     content: str
@@ -11,3 +12,9 @@ class MessageResponse(BaseModel):
     sender: str
     content: str
     created_at: datetime
+
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]  # oldest first
+    has_more: bool  # more messages exist in the direction that was paged
+    before_cursor: Optional[str] = None  # pass as ?before= for older messages
+    after_cursor: Optional[str] = None  # pass as ?after= for newer messages
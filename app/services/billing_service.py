@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.core import metrics
+from app.models.subscription import Subscription
+from app.models.user import User, SubscriptionTier
+from app.services.tier_service import set_user_tier
+
+# Stripe subscription statuses that keep Pro; past_due still has Stripe retrying the payment
+PRO_STATUSES = {"active", "trialing", "past_due"}
+
+def _timestamp(value: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value, tz=timezone.utc) if value else None
+
+def _metadata_user_id(obj: dict) -> Optional[int]:
+    user_id = (obj.get("metadata") or {}).get("user_id")
+    return int(user_id) if user_id else None
+
+def _find_subscription(db: Session, stripe_subscription_id: Optional[str], user_id: Optional[int]) -> Optional[Subscription]:
+    if stripe_subscription_id:
+        subscription = db.execute(
+            select(Subscription).filter_by(stripe_subscription_id=stripe_subscription_id)
+        ).scalars().first()
+        if subscription:
+            return subscription
+    if user_id:
+        return db.execute(
+            select(Subscription).filter_by(user_id=user_id).order_by(Subscription.id.desc())
+        ).scalars().first()
+    return None
+
+def _upsert_subscription(db: Session, subscription: Optional[Subscription], stripe_subscription_id: Optional[str], user_id: Optional[int], **fields) -> Optional[Subscription]:
+    if subscription is None:
+        if user_id is None:
+            return None
+        subscription = Subscription(user_id=user_id, stripe_subscription_id=stripe_subscription_id)
+        db.add(subscription)
+    elif stripe_subscription_id:
+        subscription.stripe_subscription_id = stripe_subscription_id
+    for name, value in fields.items():
+        if value is not None:
+            setattr(subscription, name, value)
+    return subscription
+
+# Handlers map an event's object to (stripe subscription id, user id, fields to set)
+
+def _checkout_completed(session: dict) -> tuple:
+    return session.get("subscription"), _metadata_user_id(session), {
+        "stripe_customer_id": session.get("customer"),
+        "status": "active",
+    }
+
+def _subscription_changed(obj: dict) -> tuple:
+    return obj["id"], _metadata_user_id(obj), {
+        "stripe_customer_id": obj.get("customer"),
+        "status": obj.get("status"),
+        "current_period_start": _timestamp(obj.get("current_period_start")),
+        "current_period_end": _timestamp(obj.get("current_period_end")),
+    }
+
+def _invoice_paid(invoice: dict) -> tuple:
+    lines = (invoice.get("lines") or {}).get("data") or [{}]
+    period = lines[0].get("period") or {}
+    return invoice.get("subscription"), _metadata_user_id(invoice.get("subscription_details") or {}), {
+        "stripe_customer_id": invoice.get("customer"),
+        "status": "active",
+        "current_period_start": _timestamp(period.get("start")),
+        "current_period_end": _timestamp(period.get("end")),
+    }
+
+EVENT_HANDLERS = {
+    "checkout.session.completed": _checkout_completed,
+    "customer.subscription.created": _subscription_changed,
+    "customer.subscription.updated": _subscription_changed,
+    "customer.subscription.deleted": _subscription_changed,
+    "invoice.paid": _invoice_paid,
+}
+
+def apply_stripe_event(db: Session, event: dict) -> str:
+    """
+    Record a verified Stripe event on the user's Subscription row and move the
+    user to the tier its status implies (Celery worker). Events older than the
+    last one applied to the row are skipped
+    """
+    handler = EVENT_HANDLERS.get(event["type"])
+    if handler is None:
+        metrics.incr("stripe.events.ignored")
+        return "ignored"
+
+    stripe_subscription_id, user_id, fields = handler(event["data"]["object"])
+    subscription = _find_subscription(db, stripe_subscription_id, user_id)
+    created = event.get("created")
+    if subscription is not None and created and (subscription.last_event_created or 0) > created:
+        # Stripe doesn't order events and retries arrive late: an invoice.paid
+        # older than the cancellation must not bring Pro back
+        metrics.incr("stripe.events.stale")
+        return "stale"
+
+    subscription = _upsert_subscription(db, subscription, stripe_subscription_id, user_id, last_event_created=created, **fields)
+    if subscription is None:
+        metrics.incr("stripe.events.unmatched")
+        return "unmatched"
+
+    tier = SubscriptionTier.PRO if subscription.status in PRO_STATUSES else SubscriptionTier.BASIC
+    user = db.execute(select(User).filter_by(id=subscription.user_id)).scalars().first()
+    changed = user is not None and user.subscription != tier
+    if changed:
+        user.subscription = tier
+    db.commit()
+    if changed:
+        set_user_tier(user.id, tier)
+    metrics.incr(f"stripe.events.{event['type']}")
+    return "processed"
@@ -1,97 +1,265 @@
+import asyncio
+import base64
+import json
+import logging
+from typing import AsyncIterator, Optional
 from app.models.chatroom import Chatroom
 from app.models.message import Message
 from app.schemas.chatroom import ChatroomCreate, ChatroomOut, ChatroomDetail
-from app.cache.redis_cache import get_cached_chatrooms, set_cached_chatrooms, invalidate_chatroom_cache
-from app.database import SessionLocal
+from app.cache.layered_cache import CacheFamily, invalidate_tags
+from app.cache.message_window import append_messages_async, fill_window, read_window, window_key
+from app.cache.redis_cache import async_r
+from app.core import metrics, tracing
 from app.core.config import settings
-from app.workers.tasks import fetch_gemini_reply
-from app.services.rate_limit_service import check_rate_limit, increment_message_count
+from app.core.security import AuthContext
+from app.database import AsyncSessionLocal
+from app.services.context_service import GeminiContext
+from app.services.gemini_service import stream_gemini_response
+from app.workers.tasks import run_gemini_job, run_unqueued_gemini_job, summarize_chatroom
+from app.workers.fair_queue import note_missing_token, push_job, tier_queue
+from app.services.rate_limit_service import consume_message_quota, refund_message_quota, report_message_usage
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-def get_db():
-    db = SessionLocal()
-    try:
-        return db
-    finally:
-        db.close()
+logger = logging.getLogger(__name__)
 
-def create_chatroom(user_id: int, payload: ChatroomCreate):
-    db = get_db()
-    try:
-        chatroom = Chatroom(name=payload.name, user_id=user_id)
-        db.add(chatroom)
-        db.commit()
-        db.refresh(chatroom)
-        
-        # Invalidate cache for this user
-        invalidate_chatroom_cache(user_id)
-        
-        return chatroom
-    finally:
-        db.close()
-
-def get_user_chatrooms(user_id: int):
-    cached = get_cached_chatrooms(user_id)
-    if cached:
-        return cached
-
-    db = get_db()
+chatroom_lists = CacheFamily("chatrooms", ttl=300)
+# Chatrooms are never renamed or moved to another user
+chatroom_info = CacheFamily("chatroom", ttl=3600)
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}:chatrooms"
+
+async def create_chatroom(db: AsyncSession, user_id: int, payload: ChatroomCreate):
+    chatroom = Chatroom(name=payload.name, user_id=user_id)
+    db.add(chatroom)
+    await db.commit()
+    await db.refresh(chatroom)
+
+    # Invalidate cache for this user
+    await invalidate_tags(user_tag(user_id))
+
+    return chatroom
+
+@chatroom_lists.cached(key=lambda db, user_id: user_id, tags=lambda db, user_id: [user_tag(user_id)])
+async def get_user_chatrooms(db: AsyncSession, user_id: int):
+    rooms = (await db.execute(select(Chatroom).filter(Chatroom.user_id == user_id))).scalars().all()
+    return [ChatroomOut.model_validate(room).model_dump() for room in rooms]
+
+def encode_cursor(message_id: int) -> str:
+    return base64.urlsafe_b64encode(f"msg:{message_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
     try:
-        rooms = db.query(Chatroom).filter(Chatroom.user_id == user_id).all()
-        serialized = [ChatroomOut.model_validate(room).model_dump() for room in rooms]
-        set_cached_chatrooms(user_id, serialized)
-        return serialized
-    finally:
-        db.close()
-
-def get_chatroom_detail(user_id: int, chatroom_id: int):
-    """Get detailed chatroom information including messages"""
-    db = get_db()
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, message_id = raw.split(":", 1)
+        if prefix != "msg":
+            raise ValueError(raw)
+        return int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise Exception("Invalid cursor")
+
+@chatroom_info.cached(key=lambda db, chatroom_id: chatroom_id)
+async def _get_chatroom_info(db: AsyncSession, chatroom_id: int) -> dict:
+    chatroom = (await db.execute(select(Chatroom).filter(Chatroom.id == chatroom_id))).scalars().first()
+    if not chatroom:
+        raise Exception("Chatroom not found")
+    return {"id": chatroom.id, "name": chatroom.name, "created_at": chatroom.created_at, "user_id": chatroom.user_id}
+
+async def _get_owned_chatroom(db: AsyncSession, user_id: int, chatroom_id: int) -> dict:
+    chatroom = await _get_chatroom_info(db, chatroom_id)
+    if chatroom["user_id"] != user_id:
+        raise Exception("Chatroom not found")
+    return chatroom
+
+async def can_access_chatroom(db: AsyncSession, user_id: int, chatroom_id: int) -> bool:
     try:
-        chatroom = db.query(Chatroom).filter(
-            Chatroom.id == chatroom_id, 
-            Chatroom.user_id == user_id
-        ).first()
-        
-        if not chatroom:
-            raise Exception("Chatroom not found")
-        
-        # Get messages for this chatroom
-        messages = db.query(Message).filter(
-            Message.chatroom_id == chatroom_id
-        ).order_by(Message.created_at.asc()).all()
-        
-        return {
-            "id": chatroom.id,
-            "name": chatroom.name,
-            "created_at": chatroom.created_at,
-            "messages": messages
-        }
-    finally:
-        db.close()
-
-def add_user_message_and_queue(user_id: int, chatroom_id: int, content: str):
-    # Check rate limit first
-    if not check_rate_limit(user_id):
-        raise Exception("Daily message limit exceeded. Upgrade to Pro for unlimited messages.")
-    
-    db = get_db()
+        await _get_owned_chatroom(db, user_id, chatroom_id)
+    except Exception:
+        return False
+    return True
+
+async def _query_message_page(db: AsyncSession, chatroom_id: int, before: Optional[str], after: Optional[str], limit: int) -> dict:
+    """
+    Keyset page over message ids, served by ix_messages_chatroom_id_id
+    Same order as the Redis message window, so its cursors continue here
+    """
+    if before and after:
+        raise Exception("Use either before or after, not both")
+
+    query = select(Message).filter(Message.chatroom_id == chatroom_id)
+    if after:
+        query = query.filter(Message.id > decode_cursor(after)).order_by(Message.id.asc())
+    else:
+        if before:
+            query = query.filter(Message.id < decode_cursor(before))
+        query = query.order_by(Message.id.desc())
+
+    # One extra row tells us whether another page exists
+    rows = (await db.execute(query.limit(limit + 1))).scalars().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after:
+        rows.reverse()
+
+    return {
+        "messages": rows,
+        "has_more": has_more,
+        "before_cursor": encode_cursor(rows[0].id) if rows else before,
+        "after_cursor": encode_cursor(rows[-1].id) if rows else after,
+    }
+
+async def get_messages_page(db: AsyncSession, user_id: int, chatroom_id: int, before: Optional[str] = None, after: Optional[str] = None, limit: int = 50) -> dict:
+    """Page through a chatroom's messages in either direction"""
+    await _get_owned_chatroom(db, user_id, chatroom_id)
+    return await _query_message_page(db, chatroom_id, before, after, limit)
+
+async def _load_window(db: AsyncSession, chatroom_id: int):
+    rows = (await db.execute(
+        select(Message.id, Message.sender, Message.content, Message.created_at)
+        .filter(Message.chatroom_id == chatroom_id)
+        .order_by(Message.id.desc())
+        .limit(settings.CHATROOM_WINDOW_SIZE)
+    )).all()
+    await fill_window(chatroom_id, rows)
+
+async def get_chatroom_detail(db: AsyncSession, user_id: int, chatroom_id: int, limit: int = 50):
+    """
+    Get chatroom information with its latest page of messages
+    Served from the Redis message window; the DB is read to (re)build it, or when
+    `limit` does not fit below CHATROOM_WINDOW_SIZE
+    """
+    chatroom = await _get_owned_chatroom(db, user_id, chatroom_id)
+    detail = {"id": chatroom["id"], "name": chatroom["name"], "created_at": chatroom["created_at"]}
+    if limit >= settings.CHATROOM_WINDOW_SIZE:
+        # The window can't tell whether older messages exist beyond it
+        return {**detail, **await _query_message_page(db, chatroom_id, None, None, limit)}
+
+    window = await read_window(chatroom_id, limit)
+    if window is None:
+        await _load_window(db, chatroom_id)
+        window = await read_window(chatroom_id, limit)
+    messages, has_more = window
+
+    return {
+        **detail,
+        "messages": messages,
+        "has_more": has_more,
+        "before_cursor": encode_cursor(messages[0]["id"]) if messages else None,
+        "after_cursor": encode_cursor(messages[-1]["id"]) if messages else None,
+    }
+
+async def _add_to_window(chatroom_id: int, message: Message):
+    """
+    Append a committed message to the chatroom's window and listeners; never raises
+    On a Redis error the window is dropped, to be rebuilt from the DB, since
+    it would otherwise keep serving the room without this message
+    """
     try:
-        chatroom = db.query(Chatroom).filter_by(id=chatroom_id, user_id=user_id).first()
-        if not chatroom:
-            raise Exception("Chatroom not found")
+        await append_messages_async(chatroom_id, [(message.id, message.sender, message.content, message.created_at)])
+    except Exception:
+        metrics.incr("chatroom_window.append_errors")
+        logger.warning("Could not add message %s to the window of chatroom %s", message.id, chatroom_id, exc_info=True)
+        try:
+            await async_r.delete(window_key(chatroom_id))
+        except Exception:
+            pass
 
-        # Add user message
+async def add_user_message(db: AsyncSession, auth: AuthContext, chatroom_id: int, content: str) -> tuple:
+    """
+    Count the message against today's quota, then store it
+    Returns (message, quota); raises RateLimitExceeded when over the limit
+    """
+    await _get_owned_chatroom(db, auth.user_id, chatroom_id)
+
+    quota = await consume_message_quota(auth)
+    try:
         msg = Message(chatroom_id=chatroom_id, sender="user", content=content)
         db.add(msg)
-        db.commit()
-        db.refresh(msg)
+        await db.commit()
+    except Exception:
+        # The message was never stored, don't charge for it
+        await refund_message_quota(auth.user_id, quota)
+        raise
 
-        # Increment usage count
-        increment_message_count(user_id)
+    await report_message_usage(auth.user_id, quota)
+    await _add_to_window(chatroom_id, msg)
+    return msg, quota
 
-        # Trigger Gemini async reply
-        fetch_gemini_reply.delay(content, chatroom_id, user_id)
+async def add_user_message_and_queue(db: AsyncSession, auth: AuthContext, chatroom_id: int, content: str) -> tuple:
+    msg, quota = await add_user_message(db, auth, chatroom_id, content)
+
+    # Queue the Gemini reply behind the user's earlier ones, then send a run token to the tier's queue.
+    # The message is stored and charged by now, so failures below never fail the send (a retry
+    # would store the message twice)
+    job = {
+        "prompt": content, "chatroom_id": chatroom_id, "user_id": auth.user_id, "message_id": msg.id,
+        "trace": tracing.inject()
+    }
+    try:
+        await push_job(auth.tier, auth.user_id, job)
+    except Exception:
+        metrics.incr("gemini.fair_queue.push_errors")
+        logger.warning("Could not queue the reply to message %s, running it outside the fair queue", msg.id, exc_info=True)
+        try:
+            await run_in_threadpool(run_unqueued_gemini_job.delay, job)
+        except Exception:
+            metrics.incr("gemini.replies.dropped")
+            logger.error("Could not queue the reply to message %s at all", msg.id, exc_info=True)
+        return {"status": "message queued", "message_id": msg.id}, quota
+
+    try:
+        # Celery publishes block on the broker, keep them off the event loop
+        await run_in_threadpool(run_gemini_job.apply_async, queue=tier_queue(auth.tier))
+    except Exception:
+        # The job is queued; resend_run_tokens publishes its token later
+        metrics.incr("gemini.run_tokens.publish_errors")
+        logger.warning("Could not publish a run token for message %s", msg.id, exc_info=True)
+        try:
+            await note_missing_token(auth.tier)
+        except Exception:
+            metrics.incr("gemini.run_tokens.lost")
+            logger.error("Could not record the missing run token for message %s", msg.id, exc_info=True)
+
+    return {"status": "message queued", "message_id": msg.id}, quota
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def save_bot_message_async(chatroom_id: int, content: str) -> int:
+    """Store a bot reply in its own session (the request session may be gone by now)"""
+    async with AsyncSessionLocal() as db:
+        bot_message = Message(chatroom_id=chatroom_id, sender="bot", content=content)
+        db.add(bot_message)
+        await db.commit()
+    await _add_to_window(chatroom_id, bot_message)
+    return bot_message.id
+
+async def stream_gemini_reply(chatroom_id: int, user_message_id: int, content: str, context: GeminiContext = None) -> AsyncIterator[str]:
+    """
+    Forward Gemini tokens as Server-Sent Events and store the full reply when the stream ends
+    Emits "start", then one "token" event per chunk, then "done" (or "error")
+    """
+    if context is not None and context.needs_summary:
+        await run_in_threadpool(summarize_chatroom.delay, chatroom_id)
+    yield _sse_event("start", {"message_id": user_message_id})
+
+    chunks = []
+    try:
+        async for text in stream_gemini_response(content, context):
+            chunks.append(text)
+            yield _sse_event("token", {"text": text})
+    except asyncio.CancelledError:
+        # Client went away: keep what Gemini produced so far
+        if chunks:
+            await asyncio.shield(save_bot_message_async(chatroom_id, "".join(chunks)))
+        raise
+    except Exception as e:
+        error_message = f"Error generating response: {str(e)}"
+        bot_message_id = await save_bot_message_async(chatroom_id, error_message)
+        yield _sse_event("error", {"message_id": bot_message_id, "detail": error_message})
+        return
 
-        return {"status": "message queued", "message_id": msg.id}
-    finally:
-        db.close()
+    bot_message_id = await save_bot_message_async(chatroom_id, "".join(chunks))
+    yield _sse_event("done", {"message_id": bot_message_id})
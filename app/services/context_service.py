@@ -0,0 +1,154 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import List, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.cache.redis_cache import r, async_r
+from app.core.config import settings
+from app.models.message import Message
+
+SUMMARY_TTL = 60 * 60 * 24 * 30  # 30 days, rebuilt from the DB if it expires
+
+@dataclass
+class GeminiContext:
+    """What Gemini sees for one reply: recent turns plus a summary of older ones"""
+    contents: List[dict]
+    system_instruction: Optional[str] = None
+    # True when older turns fell out of the budget and are not summarized yet
+    needs_summary: bool = False
+    context_hash: str = ""
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+def summary_key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:summary"
+
+def is_reply_failure(message: Message) -> bool:
+    # Failed replies are stored as bot messages, they are noise for Gemini
+    return message.sender == "bot" and (
+        message.content.startswith("[Gemini") or message.content.startswith("Error generating response")
+    )
+
+def _decode_summary(data: dict) -> tuple:
+    if not data:
+        return "", 0
+    return data[b"text"].decode(), int(data[b"upto_id"])
+
+def get_summary(chatroom_id: int) -> tuple:
+    """(summary text, id of the newest message folded into it)"""
+    return _decode_summary(r.hgetall(summary_key(chatroom_id)))
+
+async def get_summary_async(chatroom_id: int) -> tuple:
+    return _decode_summary(await async_r.hgetall(summary_key(chatroom_id)))
+
+def save_summary(chatroom_id: int, text: str, upto_id: int):
+    pipe = r.pipeline()
+    pipe.hset(summary_key(chatroom_id), mapping={"text": text, "upto_id": upto_id})
+    pipe.expire(summary_key(chatroom_id), SUMMARY_TTL)
+    pipe.execute()
+
+def _recent_messages_query(chatroom_id: int, after_id: int, upto_id: Optional[int]):
+    query = select(Message).filter(Message.chatroom_id == chatroom_id, Message.id > after_id)
+    if upto_id is not None:
+        query = query.filter(Message.id <= upto_id)
+    return query.order_by(Message.id.desc()).limit(settings.GEMINI_CONTEXT_MAX_MESSAGES)
+
+def split_by_budget(messages: List[Message], budget: int) -> tuple:
+    """
+    Walk newest-first messages and keep as many as fit in `budget` tokens
+    Returns (kept messages oldest-first, True if anything was left out)
+    """
+    kept, used = [], 0
+    for message in messages:
+        if is_reply_failure(message):
+            continue
+        cost = estimate_tokens(message.content)
+        if kept and used + cost > budget:
+            return list(reversed(kept)), True
+        kept.append(message)
+        used += cost
+    return list(reversed(kept)), False
+
+def _to_contents(messages: List[Message], prompt: str) -> List[dict]:
+    contents = []
+    for message in messages:
+        role = "model" if message.sender == "bot" else "user"
+        # Gemini expects alternating turns, merge consecutive ones from the same side
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"][0]["text"] += "\n" + message.content
+        else:
+            contents.append({"role": role, "parts": [{"text": message.content}]})
+
+    # The conversation has to start with the user
+    while contents and contents[0]["role"] == "model":
+        contents.pop(0)
+    # Tasks queued without a message id rely on the prompt being the last turn
+    if not contents or contents[-1]["role"] != "user":
+        contents.append({"role": "user", "parts": [{"text": prompt}]})
+    return contents
+
+def assemble_context(rows: List[Message], summary: str, prompt: str) -> GeminiContext:
+    budget = settings.GEMINI_CONTEXT_TOKEN_BUDGET - (estimate_tokens(summary) if summary else 0)
+    kept, truncated = split_by_budget(rows, max(budget, 0))
+    system_instruction = None
+    if summary:
+        system_instruction = f"Summary of the earlier conversation in this chat:\n{summary}"
+    contents = _to_contents(kept, prompt)
+    digest = hashlib.sha256(json.dumps([system_instruction, contents[:-1]]).encode()).hexdigest()
+    return GeminiContext(
+        contents=contents,
+        system_instruction=system_instruction,
+        needs_summary=truncated or len(rows) >= settings.GEMINI_CONTEXT_MAX_MESSAGES,
+        context_hash=digest,
+    )
+
+def build_context(db: Session, chatroom_id: int, prompt: str, message_id: Optional[int] = None) -> GeminiContext:
+    """
+    Build the `contents` array for a reply from the newest messages that fit the token budget
+    Turns older than the rolling summary are never loaded
+    """
+    summary, summarized_upto = get_summary(chatroom_id)
+    rows = db.execute(_recent_messages_query(chatroom_id, summarized_upto, message_id)).scalars().all()
+    return assemble_context(rows, summary, prompt)
+
+async def build_context_async(db: AsyncSession, chatroom_id: int, prompt: str, message_id: Optional[int] = None) -> GeminiContext:
+    summary, summarized_upto = await get_summary_async(chatroom_id)
+    rows = (await db.execute(_recent_messages_query(chatroom_id, summarized_upto, message_id))).scalars().all()
+    return assemble_context(rows, summary, prompt)
+
+def build_summary_prompt(summary: str, messages: List[Message]) -> str:
+    transcript = "\n".join(
+        f"{'Assistant' if m.sender == 'bot' else 'User'}: {m.content}"
+        for m in messages if not is_reply_failure(m)
+    )
+    return (
+        "You maintain a running summary of a chat between a user and an assistant. "
+        "Fold the new messages into the existing summary. Keep names, facts, decisions and open questions, "
+        f"and stay under {settings.GEMINI_SUMMARY_MAX_TOKENS * 3 // 4} words. Reply with the summary only.\n\n"
+        f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+    )
+
+def messages_to_fold(db: Session, chatroom_id: int) -> tuple:
+    """
+    Messages that are older than the recent window and not yet in the summary
+    Returns (summary, messages oldest-first); at most GEMINI_SUMMARY_BATCH per pass
+    """
+    summary, summarized_upto = get_summary(chatroom_id)
+    rows = db.execute(_recent_messages_query(chatroom_id, summarized_upto, None)).scalars().all()
+    # Keep half the budget verbatim so a summary pass is not needed on every turn
+    kept, _ = split_by_budget(rows, settings.GEMINI_CONTEXT_TOKEN_BUDGET // 2)
+    if not kept:
+        return summary, []
+    oldest_kept_id = kept[0].id
+    older = db.execute(
+        select(Message).filter(
+            Message.chatroom_id == chatroom_id,
+            Message.id > summarized_upto,
+            Message.id < oldest_kept_id,
+        ).order_by(Message.id.asc()).limit(settings.GEMINI_SUMMARY_BATCH)
+    ).scalars().all()
+    return summary, older
@@ -0,0 +1,259 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.core import metrics
+from app.core.config import settings
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Raised without calling Gemini while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls and fails fast
+    until `reset_timeout` has passed, then lets a single probe call through
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # When the half-open probe started; a probe that never reports back expires
+        self._probe_started_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self._state()
+            probe_in_flight = (
+                self._probe_started_at is not None
+                and time.monotonic() - self._probe_started_at < self.reset_timeout
+            )
+            if state == "open" or (state == "half_open" and probe_in_flight):
+                metrics.incr("gemini.calls.circuit_open")
+                raise CircuitOpenError("Gemini circuit breaker is open")
+            if state == "half_open":
+                self._probe_started_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started_at = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    metrics.incr("gemini.circuit.opened")
+                self._opened_at = time.monotonic()
+
+def _retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After"""
+    delay = random.uniform(0, min(settings.GEMINI_BACKOFF_MAX, settings.GEMINI_BACKOFF_BASE * (2 ** attempt)))
+    server_delay = _retry_after_seconds(retry_after)
+    if server_delay is not None:
+        delay = max(delay, min(server_delay, settings.GEMINI_BACKOFF_MAX))
+    return delay
+
+def _record_error(outcome: str, retrying: bool):
+    """Count a timeout or connection error; the breaker only hears about the last attempt"""
+    metrics.incr(f"gemini.calls.{outcome}")
+    if retrying:
+        metrics.incr("gemini.calls.retried")
+        return
+    metrics.incr("gemini.calls.gave_up")
+    breaker.record_failure()
+
+def _can_retry(status_code: int, attempt: int) -> bool:
+    return status_code in RETRYABLE_STATUS_CODES and attempt < settings.GEMINI_MAX_RETRIES
+
+def _record_response(status_code: int, retrying: bool):
+    """Count a response by status; the breaker only hears about the last attempt"""
+    if status_code in RETRYABLE_STATUS_CODES:
+        metrics.incr(f"gemini.calls.http_{status_code}")
+        if retrying:
+            metrics.incr("gemini.calls.retried")
+            return
+        metrics.incr("gemini.calls.gave_up")
+    else:
+        metrics.incr("gemini.calls.success" if 200 <= status_code < 300 else "gemini.calls.client_error")
+    # A 429 means we are over quota, not that Gemini is degraded
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+class GeminiClient:
+    """Keep-alive HTTP client for Gemini with timeouts, retries and a circuit breaker"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GEMINI_POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = (settings.GEMINI_CONNECT_TIMEOUT, settings.GEMINI_READ_TIMEOUT)
+
+    def post(self, url: str, payload: dict, before_retry: Optional[Callable[[], bool]] = None) -> requests.Response:
+        """
+        POST JSON to Gemini, retrying 429/5xx responses and network errors
+        `before_retry` runs before each retry (e.g. to take quota) and can refuse it
+        Returns the last response; raises CircuitOpenError or the last network error
+        """
+        breaker.before_call()
+        attempt = 0
+        while True:
+            try:
+                with metrics.timed("gemini.request_latency"):
+                    response = self.session.post(url, json=payload, timeout=self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                retrying = attempt < settings.GEMINI_MAX_RETRIES and (before_retry is None or before_retry())
+                _record_error("timeout" if isinstance(e, requests.Timeout) else "connection_error", retrying)
+                if not retrying:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            retrying = _can_retry(response.status_code, attempt) and (before_retry is None or before_retry())
+            _record_response(response.status_code, retrying)
+            if not retrying:
+                return response
+            time.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+            response.close()
+            attempt += 1
+
+breaker = CircuitBreaker(settings.GEMINI_BREAKER_FAILURE_THRESHOLD, settings.GEMINI_BREAKER_RESET_TIMEOUT)
+
+_client: Optional[GeminiClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+def get_gemini_client() -> GeminiClient:
+    """One client (and connection pool) per process; prefork children build their own"""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = GeminiClient()
+            _client_pid = os.getpid()
+        return _client
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+def get_async_gemini_client() -> httpx.AsyncClient:
+    """Shared httpx client for asyncio processes (streaming replies in the API, the async worker)"""
+    global _async_client
+    if _async_client is None:
+        # Enough connections for every concurrent call of an async worker
+        max_connections = max(settings.GEMINI_POOL_MAXSIZE * 10, settings.ASYNC_WORKER_CONCURRENCY)
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.GEMINI_READ_TIMEOUT, connect=settings.GEMINI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=settings.GEMINI_POOL_MAXSIZE),
+        )
+    return _async_client
+
+async def close_async_gemini_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+async def post_async(url: str, payload: dict, before_retry: Optional[Callable[[], Awaitable[bool]]] = None) -> httpx.Response:
+    """GeminiClient.post for asyncio code: same retries, backoff and circuit breaker"""
+    breaker.before_call()
+    client = get_async_gemini_client()
+    attempt = 0
+    while True:
+        try:
+            with metrics.timed("gemini.request_latency"):
+                response = await client.post(url, json=payload)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            retrying = attempt < settings.GEMINI_MAX_RETRIES and (before_retry is None or await before_retry())
+            _record_error("timeout" if isinstance(e, httpx.TimeoutException) else "connection_error", retrying)
+            if not retrying:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        retrying = _can_retry(response.status_code, attempt) and (before_retry is None or await before_retry())
+        _record_response(response.status_code, retrying)
+        if not retrying:
+            return response
+        await asyncio.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+        attempt += 1
+
+@asynccontextmanager
+async def stream_post(url: str, payload: dict, before_retry: Optional[Callable[[], Awaitable[bool]]] = None):
+    """
+    Open a streaming POST to Gemini. Retries happen only before the first byte
+    is forwarded, i.e. on connection errors and retryable status codes
+    """
+    breaker.before_call()
+    client = get_async_gemini_client()
+    attempt = 0
+    while True:
+        try:
+            request = client.build_request("POST", url, json=payload)
+            response = await client.send(request, stream=True)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            retrying = attempt < settings.GEMINI_MAX_RETRIES and (before_retry is None or await before_retry())
+            _record_error("timeout" if isinstance(e, httpx.TimeoutException) else "connection_error", retrying)
+            if not retrying:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        retrying = _can_retry(response.status_code, attempt) and (before_retry is None or await before_retry())
+        _record_response(response.status_code, retrying)
+        if not retrying:
+            break
+        await response.aclose()
+        await asyncio.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+        attempt += 1
+
+    try:
+        yield response
+    finally:
+        await response.aclose()
+
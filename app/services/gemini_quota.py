@@ -0,0 +1,137 @@
+import asyncio
+import time
+from app.cache.redis_cache import r, async_r
+from app.core import metrics
+from app.core.config import settings
+
+class GeminiQuotaExhausted(Exception):
+    """Raised instead of calling Gemini when the shared quota will not refill within GEMINI_QUOTA_MAX_WAIT"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Gemini quota exhausted, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+# Token bucket for requests and tokens per minute, shared by every process.
+# Each bucket refills at limit / 60 per second and holds GEMINI_QUOTA_BURST_SECONDS
+# of quota; a limit of 0 disables that bucket.
+# ARGV: now, burst seconds, requests per minute, tokens per minute, tokens to take
+# Returns "0" after taking one request and the tokens, otherwise the seconds
+# until both would fit (nothing is taken)
+_ACQUIRE_SCRIPT = """
+local now, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local limits = {tonumber(ARGV[3]), tonumber(ARGV[4])}
+local costs = {1, tonumber(ARGV[5])}
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local elapsed = math.max(now - (tonumber(state[3]) or now), 0)
+
+local levels, wait = {}, 0
+for i = 1, 2 do
+    if limits[i] > 0 then
+        local rate = limits[i] / 60
+        local capacity = rate * burst
+        -- A call bigger than the whole bucket waits for a full bucket
+        costs[i] = math.min(costs[i], capacity)
+        levels[i] = math.min((tonumber(state[i]) or capacity) + elapsed * rate, capacity)
+        if levels[i] < costs[i] then
+            wait = math.max(wait, (costs[i] - levels[i]) / rate)
+        end
+    else
+        levels[i], costs[i] = 0, 0
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+
+redis.call('HSET', KEYS[1], 'requests', levels[1] - costs[1], 'tokens', levels[2] - costs[2], 'ts', now)
+-- Idle for a whole burst means full again, so the key can go
+redis.call('EXPIRE', KEYS[1], math.ceil(burst) + 60)
+return '0'
+"""
+_acquire = r.register_script(_ACQUIRE_SCRIPT)
+_acquire_async = async_r.register_script(_ACQUIRE_SCRIPT)
+
+# Settle a reservation once Gemini reports what the call really cost. A
+# negative adjustment (the reply was longer than reserved) leaves the bucket
+# in debt, which later calls wait out.
+_SETTLE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', ARGV[1])
+end
+"""
+_settle = r.register_script(_SETTLE_SCRIPT)
+_settle_async = async_r.register_script(_SETTLE_SCRIPT)
+
+def quota_enabled() -> bool:
+    return settings.GEMINI_RPM_LIMIT > 0 or settings.GEMINI_TPM_LIMIT > 0
+
+def bucket_key(model: str) -> str:
+    # Gemini quotas are per project and model
+    return f"gemini_quota:{model}"
+
+def _args(tokens: int) -> list:
+    return [time.time(), settings.GEMINI_QUOTA_BURST_SECONDS, settings.GEMINI_RPM_LIMIT, settings.GEMINI_TPM_LIMIT, tokens]
+
+def _check_wait(wait: float, deadline: float) -> float:
+    if time.monotonic() + wait > deadline:
+        metrics.incr("gemini.quota.exhausted")
+        raise GeminiQuotaExhausted(wait)
+    metrics.incr("gemini.quota.waits")
+    return wait
+
+def acquire(model: str, tokens: int):
+    """
+    Take one request and `tokens` from the shared bucket before calling Gemini,
+    sleeping while it refills (Celery workers). Raises GeminiQuotaExhausted
+    instead of waiting longer than GEMINI_QUOTA_MAX_WAIT
+    """
+    if not quota_enabled():
+        return
+    deadline = time.monotonic() + settings.GEMINI_QUOTA_MAX_WAIT
+    started = time.monotonic()
+    while True:
+        wait = float(_acquire(keys=[bucket_key(model)], args=_args(tokens)))
+        if wait == 0:
+            metrics.observe("gemini.quota.wait", time.monotonic() - started)
+            return
+        time.sleep(_check_wait(wait, deadline))
+
+async def acquire_async(model: str, tokens: int):
+    """acquire for the API process (streaming replies)"""
+    if not quota_enabled():
+        return
+    deadline = time.monotonic() + settings.GEMINI_QUOTA_MAX_WAIT
+    started = time.monotonic()
+    while True:
+        wait = float(await _acquire_async(keys=[bucket_key(model)], args=_args(tokens)))
+        if wait == 0:
+            metrics.observe("gemini.quota.wait", time.monotonic() - started)
+            return
+        await asyncio.sleep(_check_wait(wait, deadline))
+
+def take_retry(model: str) -> bool:
+    """
+    Take one more request for a retry of a call that already holds its tokens.
+    False, instead of raising, when the bucket will not refill within GEMINI_QUOTA_MAX_WAIT
+    """
+    try:
+        acquire(model, 0)
+    except GeminiQuotaExhausted:
+        return False
+    return True
+
+async def take_retry_async(model: str) -> bool:
+    try:
+        await acquire_async(model, 0)
+    except GeminiQuotaExhausted:
+        return False
+    return True
+
+def settle(model: str, reserved: int, used: int):
+    """Give back reserved tokens the call did not use (or charge the overrun)"""
+    if settings.GEMINI_TPM_LIMIT > 0 and used != reserved:
+        _settle(keys=[bucket_key(model)], args=[reserved - used])
+
+async def settle_async(model: str, reserved: int, used: int):
+    if settings.GEMINI_TPM_LIMIT > 0 and used != reserved:
+        await _settle_async(keys=[bucket_key(model)], args=[reserved - used])
@@ -1,39 +1,186 @@
-import requests
+import json
+from typing import AsyncIterator, Optional
+from app.core import metrics
 from app.core.config import settings
+from app.cache.gemini_cache import get_or_compute, get_or_compute_async
+from app.services import gemini_quota
+from app.services.context_service import GeminiContext, estimate_tokens
+from app.services.gemini_client import CircuitOpenError, get_gemini_client, post_async, stream_post
 
-def get_gemini_response(prompt: str) -> str:
-    headers = {
-        "Content-Type": "application/json"
-    }
+def get_gemini_model() -> str:
+    """Model name taken from GEMINI_API_URL, e.g. gemini-1.5-flash"""
+    return settings.GEMINI_API_URL.rsplit("/", 1)[-1].split(":", 1)[0]
 
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
+def is_error_reply(text: str) -> bool:
+    """get_gemini_response reports failures as bracketed text instead of raising"""
+    return text.startswith("[Gemini")
+
+def build_request_body(prompt: str, context: Optional[GeminiContext] = None) -> dict:
+    """Single-turn body for a bare prompt, multi-turn body when a context was assembled"""
+    if context is None:
+        return {"contents": [{"parts": [{"text": prompt}]}]}
+    data = {"contents": context.contents}
+    if context.system_instruction:
+        data["systemInstruction"] = {"parts": [{"text": context.system_instruction}]}
+    return data
+
+def estimate_request_tokens(data: dict) -> int:
+    """Tokens reserved from the TPM bucket before a call: the prompt plus GEMINI_QUOTA_REPLY_TOKENS"""
+    parts = [part for content in data["contents"] for part in content["parts"]]
+    parts += data.get("systemInstruction", {}).get("parts", [])
+    return sum(estimate_tokens(part.get("text", "")) for part in parts) + settings.GEMINI_QUOTA_REPLY_TOKENS
+
+def reported_tokens(result: dict) -> int:
+    """Tokens Gemini billed for a call, 0 when it reports none (e.g. on errors)"""
+    return (result.get("usageMetadata") or {}).get("totalTokenCount", 0)
+
+def record_usage(result: dict):
+    """Count the tokens Gemini reports, as gemini.tokens{kind="prompt"|"reply"|"all"}"""
+    usage = result.get("usageMetadata") or {}
+    for field, kind in (("promptTokenCount", "prompt"), ("candidatesTokenCount", "reply"), ("totalTokenCount", "all")):
+        if usage.get(field):
+            metrics.incr(metrics.labeled("gemini.tokens", kind=kind), usage[field])
+
+def read_reply(response) -> tuple:
+    """(reply text or bracketed error text, tokens used) from a requests or httpx response"""
+    if response.status_code == 200:
+        try:
+            result = response.json()
+            record_usage(result)
+            used = reported_tokens(result)
+            if "candidates" in result and len(result["candidates"]) > 0:
+                parts = result["candidates"][0]["content"]["parts"]
+                return parts[0]["text"], used
+            else:
+                return "[Gemini response parsing failed - no candidates]", used
+        except Exception as e:
+            return f"[Gemini response parsing failed: {str(e)}]", 0
+    else:
+        error_detail = ""
+        try:
+            error_data = response.json()
+            if "error" in error_data:
+                error_detail = f" - {error_data['error'].get('message', '')}"
+        except:
+            pass
+        return f"[Gemini API error: {response.status_code}{error_detail}]", 0
+
+def get_gemini_response(prompt: str, context: Optional[GeminiContext] = None) -> str:
+    """
+    Reply text, or a bracketed error text if the call fails
+    Raises GeminiQuotaExhausted without calling Gemini when the shared quota is used up
+    """
+    data = build_request_body(prompt, context)
 
     # Add API key as query parameter
     url = f"{settings.GEMINI_API_URL}?key={settings.GEMINI_API_KEY}"
 
+    model = get_gemini_model()
+    reserved = estimate_request_tokens(data)
+    gemini_quota.acquire(model, reserved)
+    used = 0
     try:
-        response = requests.post(url, json=data, headers=headers)
-        
-        if response.status_code == 200:
-            try:
-                result = response.json()
-                if "candidates" in result and len(result["candidates"]) > 0:
-                    parts = result["candidates"][0]["content"]["parts"]
-                    return parts[0]["text"]
-                else:
-                    return "[Gemini response parsing failed - no candidates]"
-            except Exception as e:
-                return f"[Gemini response parsing failed: {str(e)}]"
-        else:
+        # Retries are requests too, so each takes one from the bucket
+        text, used = read_reply(get_gemini_client().post(url, data, lambda: gemini_quota.take_retry(model)))
+        return text
+    except CircuitOpenError:
+        return "[Gemini API temporarily unavailable, please try again shortly]"
+    except Exception as e:
+        return f"[Gemini API request failed: {str(e)}]"
+    finally:
+        gemini_quota.settle(model, reserved, used)
+
+async def get_gemini_response_async(prompt: str, context: Optional[GeminiContext] = None) -> str:
+    """get_gemini_response over the shared httpx client, for the asyncio worker"""
+    data = build_request_body(prompt, context)
+    url = f"{settings.GEMINI_API_URL}?key={settings.GEMINI_API_KEY}"
+
+    model = get_gemini_model()
+    reserved = estimate_request_tokens(data)
+    await gemini_quota.acquire_async(model, reserved)
+    used = 0
+    try:
+        text, used = read_reply(await post_async(url, data, lambda: gemini_quota.take_retry_async(model)))
+        return text
+    except CircuitOpenError:
+        return "[Gemini API temporarily unavailable, please try again shortly]"
+    except Exception as e:
+        return f"[Gemini API request failed: {str(e)}]"
+    finally:
+        await gemini_quota.settle_async(model, reserved, used)
+
+def get_cached_gemini_response(prompt: str, context: Optional[GeminiContext] = None) -> str:
+    """get_gemini_response behind the opt-in response cache (GEMINI_CACHE_ENABLED)"""
+    return get_or_compute(
+        prompt,
+        lambda: get_gemini_response(prompt, context),
+        model=get_gemini_model(),
+        context_hash=context.context_hash if context else "",
+        cacheable=lambda text: not is_error_reply(text),
+    )
+
+async def get_cached_gemini_response_async(prompt: str, context: Optional[GeminiContext] = None) -> str:
+    """get_gemini_response_async behind the same response cache"""
+    return await get_or_compute_async(
+        prompt,
+        lambda: get_gemini_response_async(prompt, context),
+        model=get_gemini_model(),
+        context_hash=context.context_hash if context else "",
+        cacheable=lambda text: not is_error_reply(text),
+    )
+
+def get_gemini_stream_url() -> str:
+    """streamGenerateContent endpoint for the configured model, with SSE framing"""
+    base_url = settings.GEMINI_STREAM_API_URL or settings.GEMINI_API_URL.replace(
+        ":generateContent", ":streamGenerateContent"
+    )
+    return f"{base_url}?alt=sse&key={settings.GEMINI_API_KEY}"
+
+def _extract_text(chunk: dict) -> str:
+    candidates = chunk.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+async def stream_gemini_response(prompt: str, context: Optional[GeminiContext] = None) -> AsyncIterator[str]:
+    """Yield reply text from Gemini's streamGenerateContent as chunks arrive"""
+    data = build_request_body(prompt, context)
+
+    model = get_gemini_model()
+    reserved = estimate_request_tokens(data)
+    await gemini_quota.acquire_async(model, reserved)
+    used = 0
+    usage = {}
+    try:
+        async for chunk in _stream_chunks(data, model):
+            # Each chunk repeats the running totals, the last one has the final counts
+            usage = chunk if chunk.get("usageMetadata") else usage
+            used = reported_tokens(chunk) or used
+            text = _extract_text(chunk)
+            if text:
+                yield text
+    finally:
+        record_usage(usage)
+        await gemini_quota.settle_async(model, reserved, used)
+
+async def _stream_chunks(data: dict, model: str) -> AsyncIterator[dict]:
+    async with stream_post(get_gemini_stream_url(), data, lambda: gemini_quota.take_retry_async(model)) as response:
+        if response.status_code != 200:
+            await response.aread()
             error_detail = ""
             try:
                 error_data = response.json()
                 if "error" in error_data:
                     error_detail = f" - {error_data['error'].get('message', '')}"
-            except:
+            except Exception:
                 pass
-            return f"[Gemini API error: {response.status_code}{error_detail}]"
-    except Exception as e:
-        return f"[Gemini API request failed: {str(e)}]"
+            raise Exception(f"Gemini API error: {response.status_code}{error_detail}")
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if not payload:
+                continue
+            yield json.loads(payload)
@@ -1,103 +1,133 @@
-from app.models.user import User, SubscriptionTier
+import logging
+from app.models.user import SubscriptionTier
 from app.models.subscription import UserUsage
-from app.database import SessionLocal
-from datetime import datetime, date
-from sqlalchemy import func
+from app.cache.redis_cache import async_r
+from app.core import metrics
+from app.core.security import AuthContext
+from app.workers.tasks import record_message_usage
+from dataclasses import dataclass
+from datetime import datetime, date, time, timedelta, timezone
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-def get_db():
-    db = SessionLocal()
-    try:
-        return db
-    finally:
-        db.close()
+logger = logging.getLogger(__name__)
+
+BASIC_DAILY_LIMIT = 5
+UNLIMITED = -1
+
+# Check-and-increment in one step: concurrent sends can never overshoot the limit
+_CONSUME_QUOTA = async_r.register_script("""
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+local limit = tonumber(ARGV[1])
+if limit >= 0 and count > limit then
+    redis.call('DECR', KEYS[1])
+    return {0, count - 1}
+end
+return {1, count}
+""")
+
+class RateLimitExceeded(Exception):
+    def __init__(self, quota: "QuotaResult"):
+        super().__init__("Daily message limit exceeded. Upgrade to Pro for unlimited messages.")
+        self.quota = quota
+
+@dataclass
+class QuotaResult:
+    allowed: bool
+    limit: int  # UNLIMITED for Pro
+    used: int
+    day: date  # UTC day the message was counted against
+    reset_at: datetime  # next midnight UTC
+
+    @property
+    def remaining(self) -> int:
+        return UNLIMITED if self.limit == UNLIMITED else max(0, self.limit - self.used)
+
+def _utc_day() -> tuple:
+    """Today's UTC date and the moment it ends"""
+    today = datetime.now(timezone.utc).date()
+    return today, datetime.combine(today + timedelta(days=1), time.min, tzinfo=timezone.utc)
+
+def quota_key(user_id: int, day: date) -> str:
+    return f"quota:{user_id}:{day.isoformat()}"
+
+def rate_limit_headers(quota: QuotaResult) -> dict:
+    headers = {"X-RateLimit-Reset": str(int(quota.reset_at.timestamp()))}
+    if quota.limit != UNLIMITED:
+        headers["X-RateLimit-Limit"] = str(quota.limit)
+        headers["X-RateLimit-Remaining"] = str(quota.remaining)
+    if not quota.allowed:
+        headers["Retry-After"] = str(max(1, int((quota.reset_at - datetime.now(timezone.utc)).total_seconds())))
+    return headers
+
+def daily_limit(tier: SubscriptionTier) -> int:
+    return UNLIMITED if tier == SubscriptionTier.PRO else BASIC_DAILY_LIMIT
 
-def check_rate_limit(user_id: int) -> bool:
+async def consume_message_quota(auth: AuthContext) -> QuotaResult:
     """
-    Check if user has exceeded their daily message limit
-    Returns True if user can send message, False if limit exceeded
+    Atomically check and count one message against today's (UTC) quota
+    Raises RateLimitExceeded when the user is over the limit
+    """
+    user_id = auth.user_id
+    limit = daily_limit(auth.tier)
+    today, reset_at = _utc_day()
+
+    allowed, used = await _CONSUME_QUOTA(
+        keys=[quota_key(user_id, today)],
+        args=[limit, int(reset_at.timestamp())]
+    )
+    quota = QuotaResult(allowed=bool(allowed), limit=limit, used=int(used), day=today, reset_at=reset_at)
+    if not quota.allowed:
+        raise RateLimitExceeded(quota)
+    return quota
+
+async def report_message_usage(user_id: int, quota: QuotaResult):
+    """
+    Queue the reporting copy in user_usage, once the counted message is stored
+    A lost report is only logged: the next one carries the running count
     """
-    db = get_db()
-    try:
-        # Get user subscription tier
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return False
-        
-        # Pro users have unlimited messages
-        if user.subscription == SubscriptionTier.PRO:
-            return True
-        
-        # Basic users have daily limit
-        today = date.today()
-        usage = db.query(UserUsage).filter(
-            UserUsage.user_id == user_id,
-            func.date(UserUsage.date) == today
-        ).first()
-        
-        if not usage:
-            # First message of the day
-            usage = UserUsage(user_id=user_id, message_count=0, daily_limit=5)
-            db.add(usage)
-            db.commit()
-            return True
-        
-        # Check if limit exceeded
-        if usage.message_count >= usage.daily_limit:
-            return False
-        
-        return True
-    finally:
-        db.close()
-
-def increment_message_count(user_id: int):
-    """Increment the daily message count for a user"""
-    db = get_db()
     try:
-        today = date.today()
-        usage = db.query(UserUsage).filter(
-            UserUsage.user_id == user_id,
-            func.date(UserUsage.date) == today
-        ).first()
-        
-        if usage:
-            usage.message_count += 1
-        else:
-            usage = UserUsage(user_id=user_id, message_count=1, daily_limit=5)
-            db.add(usage)
-        
-        db.commit()
-    finally:
-        db.close()
-
-def get_user_usage(user_id: int) -> dict:
+        await run_in_threadpool(record_message_usage.delay, user_id, quota.day.isoformat(), quota.used)
+    except Exception:
+        metrics.incr("usage.report_errors")
+        logger.warning("Could not queue the usage report for user %s", user_id, exc_info=True)
+
+async def refund_message_quota(user_id: int, quota: QuotaResult):
+    """Give back a message counted by consume_message_quota that was never stored, on the day it was charged"""
+    await async_r.decr(quota_key(user_id, quota.day))
+
+async def _get_used_today(db: AsyncSession, user_id: int) -> int:
+    today, _ = _utc_day()
+    used = await async_r.get(quota_key(user_id, today))
+    if used is not None:
+        return int(used)
+    # Counter missing (e.g. Redis restarted): fall back to the reporting table
+    used = (await db.execute(select(UserUsage.message_count).filter_by(
+        user_id=user_id, usage_day=today
+    ))).scalar()
+    return used or 0
+
+async def get_user_usage(db: AsyncSession, auth: AuthContext) -> dict:
     """Get current user's usage statistics"""
-    db = get_db()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return {"error": "User not found"}
-        
-        today = date.today()
-        usage = db.query(UserUsage).filter(
-            UserUsage.user_id == user_id,
-            func.date(UserUsage.date) == today
-        ).first()
-        
-        if user.subscription == SubscriptionTier.PRO:
-            return {
-                "tier": "pro",
-                "daily_limit": "unlimited",
-                "used_today": usage.message_count if usage else 0,
-                "remaining": "unlimited"
-            }
-        else:
-            used_today = usage.message_count if usage else 0
-            remaining = max(0, 5 - used_today)
-            return {
-                "tier": "basic",
-                "daily_limit": 5,
-                "used_today": used_today,
-                "remaining": remaining
-            }
-    finally:
-        db.close() 
\ No newline at end of file
+    limit = daily_limit(auth.tier)
+    used_today = await _get_used_today(db, auth.user_id)
+
+    if limit == UNLIMITED:
+        return {
+            "tier": "pro",
+            "daily_limit": "unlimited",
+            "used_today": used_today,
+            "remaining": "unlimited"
+        }
+    else:
+        remaining = max(0, limit - used_today)
+        return {
+            "tier": "basic",
+            "daily_limit": limit,
+            "used_today": used_today,
+            "remaining": remaining
+        }
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Optional
+from starlette.websockets import WebSocket
+from app.cache.message_window import chatroom_channel
+from app.cache.redis_cache import async_r
+from app.core import metrics
+
+SOCKET_QUEUE_SIZE = 100  # undelivered events per socket before it is dropped as too slow
+
+def message_event(raw_message: str) -> str:
+    # raw_message is already JSON (see app.cache.message_window.serialize_message)
+    return f'{{"event": "message", "data": {raw_message}}}'
+
+class ChatroomHub:
+    """
+    Fans chatroom events published on Redis out to this process' WebSockets
+
+    The process subscribes to a chatroom's channel only while at least one of
+    its sockets watches that chatroom, so every replica receives just the
+    events its own clients need.
+    """
+
+    def __init__(self):
+        self._rooms = {}  # chatroom_id -> set of asyncio.Queue
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def join(self, chatroom_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SOCKET_QUEUE_SIZE)
+        first = chatroom_id not in self._rooms
+        self._rooms.setdefault(chatroom_id, set()).add(queue)
+        metrics.set_gauge("realtime.sockets", sum(len(q) for q in self._rooms.values()))
+        if first:
+            if self._pubsub is None:
+                self._pubsub = async_r.pubsub()
+            await self._pubsub.subscribe(chatroom_channel(chatroom_id))
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+        return queue
+
+    async def leave(self, chatroom_id: int, queue: asyncio.Queue):
+        queues = self._rooms.get(chatroom_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        metrics.set_gauge("realtime.sockets", sum(len(q) for q in self._rooms.values()))
+        if not queues:
+            del self._rooms[chatroom_id]
+            if self._pubsub is not None:
+                await self._pubsub.unsubscribe(chatroom_channel(chatroom_id))
+
+    def _deliver(self, channel: bytes, data: bytes):
+        chatroom_id = int(channel.split(b":")[1])
+        event = message_event(data.decode())
+        for queue in list(self._rooms.get(chatroom_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The socket handler sees None and closes the connection
+                metrics.incr("realtime.slow_consumers")
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+        metrics.incr("realtime.events")
+
+    async def _read(self):
+        while self._rooms:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message and message["type"] == "message":
+                    self._deliver(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                metrics.incr("realtime.pubsub_errors")
+                await asyncio.sleep(1)
+                try:
+                    await self._resubscribe()
+                except Exception:
+                    pass  # still down, the next read fails and we retry
+
+    async def _resubscribe(self):
+        old, self._pubsub = self._pubsub, async_r.pubsub()
+        try:
+            await old.aclose()
+        except Exception:
+            pass
+        if self._rooms:
+            await self._pubsub.subscribe(*[chatroom_channel(c) for c in self._rooms])
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+
+hub = ChatroomHub()
+
+async def _forward(websocket: WebSocket, queue: asyncio.Queue):
+    while True:
+        event = await queue.get()
+        if event is None:
+            # Fell too far behind; the client reconnects and catches up with ?after=
+            await websocket.close(code=1013)
+            return
+        await websocket.send_text(event)
+
+async def _until_disconnect(websocket: WebSocket):
+    # Anything the client sends (e.g. keepalive pings) is ignored
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+async def serve_chatroom_socket(websocket: WebSocket, chatroom_id: int):
+    """Push the chatroom's new messages to an accepted socket until either side goes away"""
+    queue = await hub.join(chatroom_id)
+    tasks = [asyncio.create_task(_forward(websocket, queue)), asyncio.create_task(_until_disconnect(websocket))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await hub.leave(chatroom_id, queue)
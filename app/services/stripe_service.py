@@ -1,21 +1,16 @@
 import stripe
-from app.models.user import User, SubscriptionTier
+from app.cache.redis_cache import async_r
+from app.core import metrics
 from app.core.config import settings
+from app.core.security import AuthContext
+from app.workers.tasks import process_stripe_event
 from fastapi.responses import JSONResponse
-from app.database import SessionLocal
-
-def get_db():
-    db = SessionLocal()
-    try:
-        return db
-    except Exception:
-        db.close()
-        raise
+from starlette.concurrency import run_in_threadpool
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
-def create_stripe_checkout(user_id: int):
-    checkout_session = stripe.checkout.Session.create(
+def _create_checkout_session(user_id: int):
+    return stripe.checkout.Session.create(
         payment_method_types=["card"],
         line_items=[{
             "price": "price_1RkAo9Q90nTltBUXni2ZtlQj",  # <-- Use your real recurring price ID here
@@ -24,11 +19,24 @@ def create_stripe_checkout(user_id: int):
         mode="subscription",
         success_url="http://localhost:3000/success",
         cancel_url="http://localhost:3000/cancel",
-        metadata={"user_id": user_id}
+        metadata={"user_id": user_id},
+        # Copied onto the subscription, so its later events can be matched to the user
+        subscription_data={"metadata": {"user_id": user_id}}
     )
+
+async def create_stripe_checkout(user_id: int):
+    # The Stripe SDK is blocking, run it in the threadpool
+    checkout_session = await run_in_threadpool(_create_checkout_session, user_id)
     return {"checkout_url": checkout_session.url}
 
-def handle_stripe_webhook(payload, sig_header):
+def stripe_event_key(event_id: str) -> str:
+    return f"stripe_event:{event_id}"
+
+async def handle_stripe_webhook(payload, sig_header):
+    """
+    Verify the event, record its id and hand it to a Celery task
+    Stripe gets its 200 right away; redeliveries of a recorded event are acked and dropped
+    """
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
@@ -38,26 +46,19 @@ def handle_stripe_webhook(payload, sig_header):
     except stripe.error.SignatureVerificationError:
         return JSONResponse(status_code=400, content={"error": "Invalid signature"})
 
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-        user_id = session["metadata"]["user_id"]
-        db = get_db()
-        try:
-            user = db.query(User).filter_by(id=user_id).first()
-            if user:
-                user.subscription = SubscriptionTier.PRO
-                db.commit()
-        finally:
-            db.close()
+    key = stripe_event_key(event["id"])
+    if not await async_r.set(key, 1, nx=True, ex=settings.STRIPE_EVENT_TTL):
+        metrics.incr("stripe.events.duplicates")
+        return JSONResponse(status_code=200, content={"status": "duplicate"})
+
+    try:
+        await run_in_threadpool(process_stripe_event.delay, payload.decode() if isinstance(payload, bytes) else payload)
+    except Exception:
+        # Not queued: forget the id so Stripe's retry is accepted
+        await async_r.delete(key)
+        raise
 
     return JSONResponse(status_code=200, content={"status": "success"})
 
-def get_subscription_status(user_id: int) -> str:
-    db = get_db()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return "unknown"
-        return user.subscription.value
-    finally:
-        db.close()
+async def get_subscription_status(auth: AuthContext) -> str:
+    return auth.tier.value
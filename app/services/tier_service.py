@@ -0,0 +1,69 @@
+import time
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.cache.redis_cache import r, async_r, listen
+from app.core import metrics
+from app.core.config import settings
+from app.models.user import User, SubscriptionTier
+
+TIER_CHANNEL = "tier_invalidations"
+
+# user_id -> (tier, expires_at); per process, kept fresh by the pub/sub listener
+_local = {}
+
+def tier_key(user_id: int) -> str:
+    return f"tier:{user_id}"
+
+def _remember(user_id: int, tier: SubscriptionTier):
+    if user_id not in _local and len(_local) >= settings.TIER_CACHE_LOCAL_MAX_ENTRIES:
+        # Oldest insertion goes first
+        _local.pop(next(iter(_local)), None)
+    _local[user_id] = (tier, time.monotonic() + settings.TIER_CACHE_LOCAL_TTL)
+
+async def get_user_tier(db: AsyncSession, user_id: int) -> Optional[SubscriptionTier]:
+    """
+    Subscription tier for a user: process memory, then Redis, then the users table
+    Returns None for unknown users (which are not cached)
+    """
+    entry = _local.get(user_id)
+    if entry and entry[1] > time.monotonic():
+        metrics.incr("tier_cache.local_hits")
+        return entry[0]
+
+    cached = await async_r.get(tier_key(user_id))
+    if cached is not None:
+        metrics.incr("tier_cache.redis_hits")
+        tier = SubscriptionTier(cached.decode())
+        _remember(user_id, tier)
+        return tier
+
+    metrics.incr("tier_cache.misses")
+    user = (await db.execute(select(User).filter_by(id=user_id))).scalars().first()
+    if not user:
+        return None
+    tier = user.subscription or SubscriptionTier.BASIC
+    # Only fill an empty key: set_user_tier may have written a newer tier since our read
+    if not await async_r.set(tier_key(user_id), tier.value, ex=settings.TIER_CACHE_TTL, nx=True):
+        cached = await async_r.get(tier_key(user_id))
+        if cached is not None:
+            tier = SubscriptionTier(cached.decode())
+    _remember(user_id, tier)
+    return tier
+
+def set_user_tier(user_id: int, tier: SubscriptionTier):
+    """Call after committing a tier change (Celery worker); every API process drops its copy"""
+    pipe = r.pipeline()
+    pipe.set(tier_key(user_id), tier.value, ex=settings.TIER_CACHE_TTL)
+    pipe.publish(TIER_CHANNEL, user_id)
+    pipe.execute()
+    _local.pop(user_id, None)
+
+def _on_tier_change(data: bytes):
+    _local.pop(int(data), None)
+    metrics.incr("tier_cache.invalidations")
+
+async def listen_for_tier_changes():
+    """Background task: evict local entries when any process changes a user's tier"""
+    # Messages may have been missed while we were not subscribed
+    await listen(TIER_CHANNEL, _on_tier_change, on_subscribe=_local.clear)
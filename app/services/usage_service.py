@@ -0,0 +1,70 @@
+from datetime import date
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app.models.subscription import UserUsage, UserUsageMonthly
+
+def _insert(db: Session, model):
+    """INSERT with .on_conflict_do_update() for the session's database"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(f"No upsert for the {dialect} dialect")
+
+def _greatest(db: Session, *values):
+    # SQLite's two-argument max() is its GREATEST
+    return func.greatest(*values) if db.get_bind().dialect.name == "postgresql" else func.max(*values)
+
+def _month(db: Session, day):
+    """First day of the month of a Date column"""
+    if db.get_bind().dialect.name == "postgresql":
+        return func.date_trunc("month", day).cast(day.type)
+    return func.date(day, "start of month")
+
+def record_daily_usage(db: Session, user_id: int, usage_day: date, used: int):
+    """
+    Raise the user's count for `usage_day` to `used` in one statement (Celery worker)
+    Keeps the highest count seen, so retried or reordered reports are harmless,
+    and concurrent first reports of a day cannot create duplicate rows
+    """
+    stmt = _insert(db, UserUsage).values(user_id=user_id, usage_day=usage_day, message_count=used)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "usage_day"],
+        set_={"message_count": _greatest(db, UserUsage.message_count, stmt.excluded.message_count)},
+    ))
+
+def compact_daily_usage(db: Session, before: date) -> int:
+    """
+    Roll daily rows older than `before` into user_usage_monthly and delete them,
+    in the caller's transaction. Months cut by `before` are finished by a later
+    run, whose counts add to the same monthly row. Returns the rows compacted
+    """
+    month = _month(db, UserUsage.usage_day)
+    old = UserUsage.usage_day < before
+    rollup = db.execute(
+        select(UserUsage.user_id, month.label("month"), func.sum(UserUsage.message_count), func.count())
+        .where(old)
+        .group_by(UserUsage.user_id, "month")
+    ).all()
+    if not rollup:
+        return 0
+
+    stmt = _insert(db, UserUsageMonthly).values([
+        {
+            "user_id": user_id,
+            "month": date.fromisoformat(month) if isinstance(month, str) else month,
+            "message_count": messages or 0,
+            "active_days": days,
+        }
+        for user_id, month, messages, days in rollup
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "month"],
+        set_={
+            "message_count": UserUsageMonthly.message_count + stmt.excluded.message_count,
+            "active_days": UserUsageMonthly.active_days + stmt.excluded.active_days,
+        },
+    ))
+    return db.execute(delete(UserUsage).where(old)).rowcount
@@ -0,0 +1,216 @@
+"""
+Asyncio worker for Gemini replies
+
+    python -m app.workers.async_worker
+
+Consumes the same run_gemini_job messages as the Celery worker, from the tier
+queues, but runs up to ASYNC_WORKER_CONCURRENCY replies at once in a single
+process: Gemini calls go through the shared httpx client and database work
+through the async engine. Other tasks (summaries, usage reports) stay on the
+Celery worker started with `-Q celery`.
+"""
+import asyncio
+import queue
+import signal
+import socket
+import threading
+import time
+from datetime import datetime
+from typing import List
+from app.core import metrics, tracing
+from app.core.config import settings
+from app.database import AsyncSessionLocal, record_pool_gauges
+from app.models.user import SubscriptionTier
+from app.services.context_service import build_context_async
+from app.services.gemini_client import close_async_gemini_client
+from app.services.gemini_quota import GeminiQuotaExhausted
+from app.services.gemini_service import get_cached_gemini_response_async
+from app.workers.fair_queue import finish_job_async, pop_job_async, tier_queue
+from app.workers.tasks import celery, run_gemini_job, summarize_chatroom
+from app.workers.write_buffer import BotMessageWriteTimeout, async_bot_message_buffer
+
+async def fetch_gemini_reply_async(prompt: str, chatroom_id: int, message_id: int = None) -> dict:
+    """fetch_gemini_reply on the event loop, with replies batched by the async write buffer"""
+    try:
+        async with AsyncSessionLocal() as db:
+            context = await build_context_async(db, chatroom_id, prompt, message_id)
+        if context.needs_summary:
+            await asyncio.to_thread(summarize_chatroom.delay, chatroom_id)
+
+        response_text = await get_cached_gemini_response_async(prompt, context)
+        bot_message_id = await async_bot_message_buffer.save(chatroom_id, response_text)
+        return {"status": "success", "message_id": bot_message_id, "content": response_text}
+
+    except (GeminiQuotaExhausted, BotMessageWriteTimeout):
+        raise
+    except Exception as e:
+        error_message = f"Error generating response: {str(e)}"
+        await async_bot_message_buffer.save(chatroom_id, error_message)
+        return {"status": "error", "error": str(e)}
+
+async def run_gemini_job_async(task_id: str) -> dict:
+    """run_gemini_job for a run token received by this worker"""
+    job = await pop_job_async(task_id)
+    if job is None:
+        return {"status": "idle"}
+    metrics.observe(f"gemini.queue_wait.{job['tier']}", time.time() - job["enqueued_at"])
+    rescheduled = False
+    try:
+        with tracing.span("gemini.reply", parent=job.get("trace"), chatroom_id=job["chatroom_id"], message_id=job["message_id"]):
+            return await fetch_gemini_reply_async(job["prompt"], job["chatroom_id"], message_id=job["message_id"])
+    except GeminiQuotaExhausted as e:
+        # Same as Celery's retry: the token comes back under its id and pops the same job
+        rescheduled = True
+        metrics.incr("gemini.quota.rescheduled")
+        await asyncio.to_thread(
+            run_gemini_job.apply_async,
+            task_id=task_id, countdown=e.retry_after, queue=tier_queue(SubscriptionTier(job["tier"]))
+        )
+        return {"status": "rescheduled"}
+    finally:
+        if not rescheduled:
+            await finish_job_async(task_id)
+
+def default_queues() -> List[str]:
+    return [tier_queue(tier) for tier in SubscriptionTier]
+
+class AsyncGeminiWorker:
+    """
+    Runs Celery task messages on one event loop
+
+    A thread consumes the queues with kombu and hands each message to the
+    loop; up to `concurrency` handlers run at once. Kombu channels are not
+    thread-safe, so finished messages go back to that thread to be acked,
+    which happens after the handler returns (like acks_late).
+    """
+
+    handlers = {run_gemini_job.name: run_gemini_job_async}
+
+    def __init__(self, queues: List[str], concurrency: int):
+        self.queues = queues
+        self.concurrency = concurrency
+        self._loop = None
+        self._slots = None
+        self._waiting = set()  # received, not started yet (eta or no free slot)
+        self._running = set()
+        self._finished = queue.SimpleQueue()  # (message, ack) for the consumer thread
+        self._draining = threading.Event()  # stop taking messages
+        self._stopped = threading.Event()  # every handler is done, the consumer can exit
+
+    # Consumer thread
+
+    def _on_message(self, body, message):
+        handler = self.handlers.get(message.headers.get("task"))
+        if handler is None:
+            # Nothing else should be routed to these queues; the Celery worker does the same
+            metrics.incr("async_worker.unknown_tasks")
+            message.reject(requeue=False)
+            return
+        metrics.incr("async_worker.received")
+        self._loop.call_soon_threadsafe(self._start, handler, message)
+
+    def _settle_finished(self):
+        while True:
+            try:
+                message, ack = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                message.ack() if ack else message.requeue()
+            except Exception:
+                # Its channel is gone; the broker redelivers it and an idle token is harmless
+                metrics.incr("async_worker.ack_errors")
+
+    def _consume(self):
+        while not self._stopped.is_set():
+            try:
+                with celery.connection_for_read() as conn:
+                    consumer = conn.Consumer(
+                        [celery.amqp.queues[name] for name in self.queues],
+                        callbacks=[self._on_message],
+                        accept=["json"],
+                        prefetch_count=self.concurrency,
+                    )
+                    consumer.consume()
+                    consuming = True
+                    while not self._stopped.is_set():
+                        self._settle_finished()
+                        if self._draining.is_set():
+                            if consuming:
+                                consumer.cancel()
+                                consuming = False
+                            time.sleep(0.1)
+                            continue
+                        try:
+                            conn.drain_events(timeout=0.1)
+                        except socket.timeout:
+                            pass
+                    self._settle_finished()
+            except Exception:
+                metrics.incr("async_worker.connection_errors")
+                time.sleep(1)
+
+    # Event loop
+
+    def _start(self, handler, message):
+        task = asyncio.ensure_future(self._run(handler, message))
+        self._waiting.add(task)
+        task.add_done_callback(self._waiting.discard)
+
+    async def _run(self, handler, message):
+        task = asyncio.current_task()
+        try:
+            eta = message.headers.get("eta")
+            if eta:
+                await asyncio.sleep(max(datetime.fromisoformat(eta).timestamp() - time.time(), 0))
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            # Shutting down before it ran: give the message back to the broker
+            self._finished.put((message, False))
+            raise
+        self._waiting.discard(task)
+        self._running.add(task)
+        metrics.set_gauge("async_worker.running", len(self._running))
+        try:
+            parent = {name: message.headers[name] for name in tracing.fields() if name in message.headers}
+            with metrics.timed("async_worker.task_time"), tracing.span(
+                message.headers["task"], parent=parent, kind="consumer", **{"celery.task_id": message.headers["id"]}
+            ):
+                await handler(message.headers["id"])
+        except Exception:
+            metrics.incr("async_worker.task_errors")
+        finally:
+            self._slots.release()
+            self._running.discard(task)
+            self._finished.put((message, True))
+            metrics.set_gauge("async_worker.running", len(self._running))
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(sig, stop.set)
+
+        consumer = threading.Thread(target=self._consume, name="async-worker-consumer", daemon=True)
+        consumer.start()
+        await stop.wait()
+
+        # Warm shutdown: stop receiving, requeue what has not started, finish the rest
+        self._draining.set()
+        for task in list(self._waiting):
+            task.cancel()
+        await asyncio.gather(*self._waiting, *self._running, return_exceptions=True)
+        self._stopped.set()
+        await asyncio.to_thread(consumer.join)
+        await close_async_gemini_client()
+
+def main():
+    tracing.setup("worker")
+    if settings.WORKER_METRICS_PORT:
+        metrics.serve(settings.WORKER_METRICS_PORT, collect=record_pool_gauges)
+    queues = settings.ASYNC_WORKER_QUEUES.split(",") if settings.ASYNC_WORKER_QUEUES else default_queues()
+    asyncio.run(AsyncGeminiWorker([q.strip() for q in queues], settings.ASYNC_WORKER_CONCURRENCY).run())
+
+if __name__ == "__main__":
+    main()
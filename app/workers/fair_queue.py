@@ -0,0 +1,138 @@
+import json
+import random
+import time
+from typing import Optional
+from app.cache.redis_cache import r, async_r
+from app.core.config import settings
+from app.models.user import SubscriptionTier
+
+INFLIGHT_KEY = "fairq:inflight"  # Celery task id -> job it popped, until the job finishes
+
+# A user joins the tier's ring when their list goes from empty to non-empty
+_ENQUEUE_SCRIPT = """
+redis.call('RPUSH', KEYS[2], ARGV[2])
+if redis.call('LLEN', KEYS[2]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+"""
+_enqueue = async_r.register_script(_ENQUEUE_SCRIPT)
+
+# ARGV: task id, random number in [0, 1), then tier/weight pairs.
+# A redelivered task gets the job it popped before. Otherwise pick a tier with
+# pending work (weighted), then the next user in that tier's ring, and take
+# their oldest job; users with more work go back to the end of the ring.
+_POP_SCRIPT = """
+local job = redis.call('HGET', KEYS[1], ARGV[1])
+if job then
+    return job
+end
+
+local tiers, total = {}, 0
+for i = 3, #ARGV, 2 do
+    if redis.call('LLEN', 'fairq:' .. ARGV[i] .. ':ring') > 0 then
+        local weight = tonumber(ARGV[i + 1])
+        total = total + weight
+        table.insert(tiers, {ARGV[i], weight})
+    end
+end
+if total == 0 then
+    return false
+end
+
+local pick = tonumber(ARGV[2]) * total
+local tier = tiers[#tiers][1]
+for _, t in ipairs(tiers) do
+    if pick < t[2] then
+        tier = t[1]
+        break
+    end
+    pick = pick - t[2]
+end
+
+local ring = 'fairq:' .. tier .. ':ring'
+local user = redis.call('LPOP', ring)
+local list = 'fairq:' .. tier .. ':user:' .. user
+job = redis.call('LPOP', list)
+if redis.call('LLEN', list) > 0 then
+    redis.call('RPUSH', ring, user)
+end
+redis.call('HSET', KEYS[1], ARGV[1], job)
+return job
+"""
+_pop = r.register_script(_POP_SCRIPT)
+_pop_async = async_r.register_script(_POP_SCRIPT)
+
+def tier_queue(tier: SubscriptionTier) -> str:
+    """Celery queue carrying the run tokens for a tier"""
+    return f"gemini_{tier.value}"
+
+def tier_weights() -> dict:
+    """GEMINI_TIER_WEIGHTS ("pro:3,basic:1") as {"pro": 3, "basic": 1}"""
+    weights = {}
+    for part in settings.GEMINI_TIER_WEIGHTS.split(","):
+        tier, weight = part.split(":")
+        weights[SubscriptionTier(tier.strip()).value] = max(int(weight), 1)
+    return weights
+
+def ring_key(tier: str) -> str:
+    return f"fairq:{tier}:ring"
+
+def user_queue_key(tier: str, user_id: int) -> str:
+    return f"fairq:{tier}:user:{user_id}"
+
+def missing_tokens_key(tier: str) -> str:
+    return f"fairq:{tier}:missing_tokens"
+
+async def push_job(tier: SubscriptionTier, user_id: int, job: dict):
+    """Append a job to the user's list in their tier (API side)"""
+    job = dict(job, tier=tier.value, enqueued_at=time.time())
+    await _enqueue(
+        keys=[ring_key(tier.value), user_queue_key(tier.value, user_id)],
+        args=[user_id, json.dumps(job)]
+    )
+
+def _pop_args(task_id: str) -> list:
+    args = [task_id, random.random()]
+    for tier, weight in tier_weights().items():
+        args.extend([tier, weight])
+    return args
+
+def pop_job(task_id: str) -> Optional[dict]:
+    """Claim the next job for a run token (worker side)"""
+    job = _pop(keys=[INFLIGHT_KEY], args=_pop_args(task_id))
+    return json.loads(job) if job else None
+
+async def pop_job_async(task_id: str) -> Optional[dict]:
+    job = await _pop_async(keys=[INFLIGHT_KEY], args=_pop_args(task_id))
+    return json.loads(job) if job else None
+
+async def note_missing_token(tier: SubscriptionTier):
+    """Record a queued job whose run token could not be published (API side)"""
+    await async_r.incr(missing_tokens_key(tier.value))
+
+def take_missing_tokens(tier: str) -> int:
+    """Claim the count of unpublished run tokens for a tier, resetting it (worker side)"""
+    with r.pipeline() as pipe:
+        pipe.get(missing_tokens_key(tier))
+        pipe.delete(missing_tokens_key(tier))
+        missing, _ = pipe.execute()
+    return int(missing or 0)
+
+def return_missing_tokens(tier: str, count: int):
+    r.incrby(missing_tokens_key(tier), count)
+
+def finish_job(task_id: str):
+    r.hdel(INFLIGHT_KEY, task_id)
+
+async def finish_job_async(task_id: str):
+    await async_r.hdel(INFLIGHT_KEY, task_id)
+
+def queue_depths() -> dict:
+    """Users waiting per tier and jobs claimed by run tokens, for metrics"""
+    with r.pipeline() as pipe:
+        tiers = list(tier_weights())
+        for tier in tiers:
+            pipe.llen(ring_key(tier))
+        pipe.hlen(INFLIGHT_KEY)
+        *waiting, inflight = pipe.execute()
+    return {"waiting_users": dict(zip(tiers, waiting)), "inflight": inflight}
@@ -1,16 +1,52 @@
-from celery import Celery
+from celery import Celery, Task
+from celery.schedules import crontab
+from celery.exceptions import Retry
+from celery.signals import before_task_publish, worker_init, worker_ready
+import json
 import requests
+import time
+from datetime import date, datetime, timedelta, timezone
 from app.core.config import settings
-from app.database import SessionLocal
-from app.models.message import Message
-from app.services.gemini_service import get_gemini_response
+from app.database import SessionLocal, record_pool_gauges
+from app.workers.write_buffer import BotMessageWriteTimeout, save_bot_message
+from app.cache.redis_cache import r
+from app.core import metrics, tracing
+from app.workers.fair_queue import pop_job, finish_job, return_missing_tokens, take_missing_tokens, tier_queue
+from app.models.user import SubscriptionTier
+from app.services.billing_service import apply_stripe_event
+from app.services.context_service import build_context, messages_to_fold, build_summary_prompt, save_summary
+from app.services.gemini_quota import GeminiQuotaExhausted
+from app.services.gemini_service import get_cached_gemini_response, get_gemini_response, is_error_reply
+from app.services.usage_service import compact_daily_usage, record_daily_usage
+
+class InstrumentedTask(Task):
+    """Times every run (celery.task.duration{task}) inside a span that continues the publisher's trace"""
+
+    def __call__(self, *args, **kwargs):
+        # Called directly (not from a message) there are no headers, and the span nests in the caller's
+        parent = {name: value for name in tracing.fields() if (value := self.request.get(name))} or None
+        outcome = "success"
+        start = time.perf_counter()
+        try:
+            with tracing.span(self.name, parent=parent, kind="consumer", **{"celery.task_id": self.request.id or ""}):
+                return super().__call__(*args, **kwargs)
+        except Retry:
+            outcome = "retry"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            metrics.observe(metrics.labeled("celery.task.duration", task=self.name), time.perf_counter() - start)
+            metrics.incr(metrics.labeled("celery.tasks", task=self.name, outcome=outcome))
 
 # Create Celery app
 celery = Celery(
     "worker",
     broker=settings.CELERY_BROKER_URL,
     backend=settings.CELERY_RESULT_BACKEND,
-    include=['app.workers.tasks']
+    include=['app.workers.tasks'],
+    task_cls=InstrumentedTask,
 )
 
 # Configure Celery
@@ -20,55 +56,207 @@ celery.conf.update(
     result_serializer='json',
     timezone='UTC',
     enable_utc=True,
+    # Run by `celery -A app.workers.tasks beat`
+    beat_schedule={
+        "compact-user-usage": {
+            "task": "app.workers.tasks.compact_user_usage",
+            "schedule": crontab(hour=3, minute=30),
+        },
+        "resend-run-tokens": {
+            "task": "app.workers.tasks.resend_run_tokens",
+            "schedule": 60.0,
+        },
+    },
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        return db
-    finally:
-        db.close()
+@before_task_publish.connect
+def _propagate_trace(headers=None, **kwargs):
+    # Task messages carry the publisher's trace context, read back by InstrumentedTask
+    headers.update(tracing.inject())
 
-@celery.task
-def fetch_gemini_reply(prompt: str, chatroom_id: int, user_id: int = None):
-    """Fetch reply from Gemini API and save to database"""
+@worker_init.connect
+def _setup_tracing(**kwargs):
+    tracing.setup("worker")
+
+@worker_ready.connect
+def _serve_metrics(**kwargs):
+    # Tasks only report here when they run in this process (--pool threads or solo)
+    if settings.WORKER_METRICS_PORT:
+        metrics.serve(settings.WORKER_METRICS_PORT, collect=record_pool_gauges)
+
+def broker_queue_depths() -> dict:
+    """Messages waiting in the Celery queues: summaries and reports, and run tokens per tier"""
+    names = ["celery"] + [tier_queue(tier) for tier in SubscriptionTier]
+    depths = {}
+    with celery.connection_for_read() as conn:
+        channel = conn.default_channel
+        for name in names:
+            try:
+                depths[name] = channel.queue_declare(queue=name, passive=True).message_count
+            except conn.channel_errors:
+                # Never declared yet: nothing was ever published to it
+                depths[name] = 0
+                channel = conn.channel()
+    return depths
+
+@celery.task(acks_late=True)
+def fetch_gemini_reply(prompt: str, chatroom_id: int, user_id: int = None, message_id: int = None):
+    """
+    Fetch reply from Gemini API and save to database
+    The reply is committed (in a batch with other replies) before the task returns and is acked
+    GeminiQuotaExhausted propagates so the caller can run the reply later, and
+    BotMessageWriteTimeout because the reply is still buffered and may yet commit
+    """
     try:
+        # Recent turns within the token budget, plus the rolling summary
+        with SessionLocal() as db:
+            context = build_context(db, chatroom_id, prompt, message_id)
+        if context.needs_summary:
+            summarize_chatroom.delay(chatroom_id)
+
         # Get Gemini response
-        response_text = get_gemini_response(prompt)
-        
+        response_text = get_cached_gemini_response(prompt, context)
+
         # Save response to database
-        db = get_db()
-        try:
-            bot_message = Message(
-                chatroom_id=chatroom_id,
-                sender="bot",
-                content=response_text
-            )
-            db.add(bot_message)
-            db.commit()
-            db.refresh(bot_message)
-            
-            return {
-                "status": "success",
-                "message_id": bot_message.id,
-                "content": response_text
-            }
-        finally:
-            db.close()
-            
+        bot_message_id = save_bot_message(chatroom_id, response_text)
+
+        return {
+            "status": "success",
+            "message_id": bot_message_id,
+            "content": response_text
+        }
+
+    except (GeminiQuotaExhausted, BotMessageWriteTimeout):
+        raise
     except Exception as e:
         # Log error and save error message to database
         error_message = f"Error generating response: {str(e)}"
-        db = get_db()
-        try:
-            bot_message = Message(
-                chatroom_id=chatroom_id,
-                sender="bot",
-                content=error_message
-            )
-            db.add(bot_message)
-            db.commit()
-        finally:
-            db.close()
-        
+        save_bot_message(chatroom_id, error_message)
+
         return {"status": "error", "error": str(e)}
+
+@celery.task(bind=True, acks_late=True)
+def run_gemini_job(self):
+    """
+    Run token for the fair queue: each token runs one queued reply, picked by
+    tier weight and then round-robin across the users waiting in that tier
+    """
+    job = pop_job(self.request.id)
+    if job is None:
+        return {"status": "idle"}
+    metrics.observe(f"gemini.queue_wait.{job['tier']}", time.time() - job["enqueued_at"])
+    rescheduled = False
+    try:
+        # The token may run another user's job, so the reply joins the trace of the request that queued it
+        with tracing.span("gemini.reply", parent=job.get("trace"), chatroom_id=job["chatroom_id"], message_id=job["message_id"]):
+            return fetch_gemini_reply(job["prompt"], job["chatroom_id"], job["user_id"], message_id=job["message_id"])
+    except GeminiQuotaExhausted as e:
+        # The job stays claimed by this task id, so the retry pops the same job
+        rescheduled = True
+        metrics.incr("gemini.quota.rescheduled")
+        raise self.retry(countdown=e.retry_after, max_retries=None)
+    finally:
+        if not rescheduled:
+            finish_job(self.request.id)
+
+@celery.task(bind=True, acks_late=True)
+def run_unqueued_gemini_job(self, job: dict):
+    """
+    A reply whose job could not be pushed to the fair queue (Redis down when
+    the message was sent), run straight from this task on the default queue
+    """
+    try:
+        with tracing.span("gemini.reply", parent=job.get("trace"), chatroom_id=job["chatroom_id"], message_id=job["message_id"]):
+            return fetch_gemini_reply(job["prompt"], job["chatroom_id"], job["user_id"], message_id=job["message_id"])
+    except GeminiQuotaExhausted as e:
+        metrics.incr("gemini.quota.rescheduled")
+        raise self.retry(countdown=e.retry_after, max_retries=None)
+
+@celery.task
+def resend_run_tokens():
+    """
+    Publish the run tokens the API failed to send (every minute, via beat)
+    Tokens are interchangeable, so one per missed publish drains the orphaned jobs
+    """
+    sent = {}
+    for tier in SubscriptionTier:
+        missing = take_missing_tokens(tier.value)
+        for published in range(missing):
+            try:
+                run_gemini_job.apply_async(queue=tier_queue(tier))
+            except Exception:
+                return_missing_tokens(tier.value, missing - published)
+                raise
+        sent[tier.value] = missing
+    metrics.incr("gemini.run_tokens.resent", sum(sent.values()))
+    return {"status": "success", "sent": sent}
+
+@celery.task
+def summarize_chatroom(chatroom_id: int):
+    """Fold turns that no longer fit the context budget into the chatroom's rolling summary"""
+    lock_key = f"chatroom:{chatroom_id}:summary:lock"
+    # One summarizer per chatroom at a time; extra triggers are dropped
+    if not r.set(lock_key, 1, nx=True, ex=120):
+        return {"status": "skipped"}
+    try:
+        with SessionLocal() as db:
+            summary, older = messages_to_fold(db, chatroom_id)
+            if not older:
+                return {"status": "up to date"}
+
+            try:
+                new_summary = get_gemini_response(build_summary_prompt(summary, older))
+            except GeminiQuotaExhausted as e:
+                summarize_chatroom.apply_async((chatroom_id,), countdown=e.retry_after)
+                return {"status": "rescheduled"}
+            if is_error_reply(new_summary):
+                return {"status": "error", "error": new_summary}
+            save_summary(chatroom_id, new_summary, older[-1].id)
+    finally:
+        r.delete(lock_key)
+
+    # Long backlog: keep folding in batches
+    if len(older) >= settings.GEMINI_SUMMARY_BATCH:
+        summarize_chatroom.delay(chatroom_id)
+    return {"status": "success", "upto_id": older[-1].id}
+
+def usage_retention_cutoff() -> date:
+    """Oldest UTC day still kept as a daily user_usage row"""
+    return datetime.now(timezone.utc).date() - timedelta(days=settings.USAGE_DAILY_RETENTION_DAYS)
+
+@celery.task
+def record_message_usage(user_id: int, day: str, used: int):
+    """
+    Mirror the Redis quota counter into user_usage for reporting
+    Stores the highest count seen, so retried or reordered tasks are harmless
+    """
+    usage_day = date.fromisoformat(day)
+    if usage_day < usage_retention_cutoff():
+        # Already rolled into user_usage_monthly, a new daily row would be counted twice
+        return {"status": "skipped"}
+    with SessionLocal() as db:
+        record_daily_usage(db, user_id, usage_day, used)
+        db.commit()
+    return {"status": "success", "message_count": used}
+
+@celery.task
+def compact_user_usage():
+    """Roll daily user_usage rows past USAGE_DAILY_RETENTION_DAYS into monthly totals (daily, via beat)"""
+    with SessionLocal() as db:
+        compacted = compact_daily_usage(db, usage_retention_cutoff())
+        db.commit()
+    metrics.incr("usage.compacted_rows", compacted)
+    return {"status": "success", "compacted": compacted}
+
+@celery.task(bind=True, acks_late=True, max_retries=5)
+def process_stripe_event(self, payload: str):
+    """Apply a verified Stripe webhook event (see app.services.stripe_service.handle_stripe_webhook)"""
+    event = json.loads(payload)
+    try:
+        with SessionLocal() as db:
+            status = apply_stripe_event(db, event)
+    except Exception as e:
+        # The event id is already recorded, so Stripe will not deliver it again
+        metrics.incr("stripe.events.retried")
+        raise self.retry(exc=e, countdown=2 ** self.request.retries * 5)
+    return {"status": status, "event_id": event["id"], "type": event["type"]}
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Optional
+from sqlalchemy import insert
+from app.cache.message_window import append_messages, append_messages_async, window_key
+from app.cache.redis_cache import r, async_r
+from app.core import metrics
+from app.core.config import settings
+from app.database import AsyncSessionLocal, SessionLocal
+from app.models.message import Message
+
+class BotMessageWriteTimeout(Exception):
+    """The reply was not committed within WORKER_WRITE_TIMEOUT; it is still queued and may commit later"""
+
+def _by_room(rows: list, inserted: list) -> dict:
+    """Committed rows as {chatroom_id: [(id, sender, content, created_at)]} for the message windows"""
+    rooms = {}
+    for row, (message_id, created_at) in zip(rows, inserted):
+        rooms.setdefault(row["chatroom_id"], []).append((message_id, row["sender"], row["content"], created_at))
+    return rooms
+
+class BotMessageBuffer:
+    """
+    Write-behind buffer for bot replies in a worker process
+
+    Tasks submit rows and block on the returned future, which resolves with
+    the message id once the batch holding it is committed. Batches flush when
+    they reach `max_batch` rows or when the oldest row has waited `max_wait`
+    seconds, whichever comes first.
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._pending = []
+        self._oldest_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def submit(self, chatroom_id: int, content: str) -> Future:
+        future = Future()
+        with self._cond:
+            self._ensure_flusher()
+            if not self._pending:
+                self._oldest_at = time.monotonic()
+            self._pending.append(({"chatroom_id": chatroom_id, "sender": "bot", "content": content}, future))
+            self._cond.notify()
+        return future
+
+    def _ensure_flusher(self):
+        # Prefork children inherit the object (and the parent's rows) but not the thread
+        if self._pid != os.getpid():
+            self._pending = []
+            self._thread = None
+            self._pid = os.getpid()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="bot-message-flusher", daemon=True)
+            self._thread.start()
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while True:
+                if self._pending:
+                    waited = time.monotonic() - self._oldest_at
+                    if len(self._pending) >= self.max_batch or waited >= self.max_wait:
+                        break
+                    self._cond.wait(self.max_wait - waited)
+                else:
+                    self._cond.wait()
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            self._oldest_at = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            self._flush(self._take_batch())
+
+    def _flush(self, batch: list):
+        rows = [row for row, _ in batch]
+        try:
+            with metrics.timed("worker.bot_messages.flush_time"), SessionLocal() as db:
+                # One INSERT ... RETURNING for the whole batch, ids come back in row order
+                inserted = db.execute(
+                    insert(Message).returning(Message.id, Message.created_at, sort_by_parameter_order=True),
+                    rows,
+                ).all()
+                db.commit()
+        except Exception as e:
+            metrics.incr("worker.bot_messages.flush_errors")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        metrics.observe("worker.bot_messages.batch_size", len(batch))
+        metrics.incr("worker.bot_messages.written", len(batch))
+        self._update_windows(rows, inserted)
+        for (_, future), (message_id, _) in zip(batch, inserted):
+            future.set_result(message_id)
+
+    def _update_windows(self, rows: list, inserted: list):
+        rooms = _by_room(rows, inserted)
+        try:
+            append_messages(rooms)
+        except Exception:
+            metrics.incr("worker.bot_messages.window_errors")
+            # A window missing these rows must not be served; it is rebuilt from the DB
+            try:
+                r.delete(*[window_key(chatroom_id) for chatroom_id in rooms])
+            except Exception:
+                pass
+
+class AsyncBotMessageBuffer:
+    """
+    BotMessageBuffer for the asyncio worker: the same batching, flushed by a
+    task on the worker's event loop through the async engine
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._oldest_at: Optional[float] = None
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def save(self, chatroom_id: int, content: str) -> int:
+        """Queue a reply; returns its message id once the batch holding it is committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._ensure_flusher()
+        if not self._pending:
+            self._oldest_at = time.monotonic()
+        self._pending.append(({"chatroom_id": chatroom_id, "sender": "bot", "content": content}, future))
+        self._changed.set()
+        try:
+            # Shielded: a reply that times out stays in its batch
+            return await asyncio.wait_for(asyncio.shield(future), settings.WORKER_WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.incr("worker.bot_messages.write_timeouts")
+            raise BotMessageWriteTimeout(f"Reply for chatroom {chatroom_id} not committed after {settings.WORKER_WRITE_TIMEOUT}s")
+
+    def _ensure_flusher(self):
+        if self._task is None or self._task.done():
+            self._changed = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            waited = time.monotonic() - self._oldest_at
+            if len(self._pending) < self.max_batch and waited < self.max_wait:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.max_wait - waited)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            self._oldest_at = time.monotonic() if self._pending else None
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        rows = [row for row, _ in batch]
+        try:
+            with metrics.timed("worker.bot_messages.flush_time"):
+                async with AsyncSessionLocal() as db:
+                    inserted = (await db.execute(
+                        insert(Message).returning(Message.id, Message.created_at, sort_by_parameter_order=True),
+                        rows,
+                    )).all()
+                    await db.commit()
+        except Exception as e:
+            metrics.incr("worker.bot_messages.flush_errors")
+            for _, future in batch:
+                future.set_exception(e)
+                future.exception()  # the waiter may have timed out; don't warn about it
+            return
+
+        metrics.observe("worker.bot_messages.batch_size", len(batch))
+        metrics.incr("worker.bot_messages.written", len(batch))
+        await self._update_windows(rows, inserted)
+        for (_, future), (message_id, _) in zip(batch, inserted):
+            future.set_result(message_id)
+
+    async def _update_windows(self, rows: list, inserted: list):
+        rooms = _by_room(rows, inserted)
+        try:
+            await asyncio.gather(*(append_messages_async(chatroom_id, messages) for chatroom_id, messages in rooms.items()))
+        except Exception:
+            metrics.incr("worker.bot_messages.window_errors")
+            try:
+                await async_r.delete(*[window_key(chatroom_id) for chatroom_id in rooms])
+            except Exception:
+                pass
+
+bot_message_buffer = BotMessageBuffer(settings.WORKER_WRITE_BATCH_SIZE, settings.WORKER_WRITE_BATCH_WINDOW)
+async_bot_message_buffer = AsyncBotMessageBuffer(settings.WORKER_WRITE_BATCH_SIZE, settings.WORKER_WRITE_BATCH_WINDOW)
+
+def save_bot_message(chatroom_id: int, content: str) -> int:
+    """Store a bot reply through the write buffer; returns once it is committed"""
+    try:
+        return bot_message_buffer.submit(chatroom_id, content).result(timeout=settings.WORKER_WRITE_TIMEOUT)
+    except FutureTimeout:
+        metrics.incr("worker.bot_messages.write_timeouts")
+        raise BotMessageWriteTimeout(f"Reply for chatroom {chatroom_id} not committed after {settings.WORKER_WRITE_TIMEOUT}s")
@@ -0,0 +1,91 @@
+"""
+In-process stand-in for the Gemini API
+
+Answers :generateContent with a canned reply and usageMetadata after a
+configurable latency, and :streamGenerateContent with SSE chunks spread over
+that latency. Point GEMINI_API_URL at `FakeGemini.url`.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODEL_PATH = "/v1beta/models/gemini-1.5-flash"
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeGemini"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.record_call()
+        prompt_tokens = len(json.dumps(body)) // 4 + 1
+        if random.random() < self.server.error_rate:
+            self._send_json(503, {"error": {"code": 503, "message": "fake overload"}})
+        elif ":streamGenerateContent" in self.path:
+            self._stream(prompt_tokens)
+        else:
+            time.sleep(self.server.latency())
+            self._send_json(200, {
+                "candidates": [{"content": {"parts": [{"text": " ".join(self.server.reply_words)}], "role": "model"}}],
+                "usageMetadata": self.server.usage(prompt_tokens),
+            })
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, prompt_tokens: int):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = self.server.reply_words
+        delay = self.server.latency() / len(words)
+        for i, word in enumerate(words):
+            time.sleep(delay)
+            chunk = {"candidates": [{"content": {"parts": [{"text": word + " "}], "role": "model"}}]}
+            if i == len(words) - 1:
+                chunk["usageMetadata"] = self.server.usage(prompt_tokens)
+            self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+            self.wfile.flush()
+        self.close_connection = True
+
+class FakeGemini(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0, reply_words: int = 40):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.mean_latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply_words = [f"word{i}" for i in range(max(reply_words, 1))]
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{MODEL_PATH}:generateContent"
+
+    def latency(self) -> float:
+        return max(self.mean_latency + random.uniform(-self.jitter, self.jitter), 0.0)
+
+    def usage(self, prompt_tokens: int) -> dict:
+        reply_tokens = len(self.reply_words) * 2
+        return {"promptTokenCount": prompt_tokens, "candidatesTokenCount": reply_tokens, "totalTokenCount": prompt_tokens + reply_tokens}
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def start(self) -> "FakeGemini":
+        threading.Thread(target=self.serve_forever, name="fake-gemini", daemon=True).start()
+        return self
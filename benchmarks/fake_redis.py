@@ -0,0 +1,46 @@
+"""
+Redis stand-in for benchmark runs, reachable over TCP so the API and the
+workers (separate processes) share it
+
+    python -m benchmarks.fake_redis --port 6390
+"""
+import argparse
+import redis
+from fakeredis import TcpFakeServer
+from fakeredis._clients._tcp_server import TCPFakeRequestHandler
+
+class RequestHandler(TCPFakeRequestHandler):
+    """
+    Send error replies back instead of dropping the connection. The stock
+    handler closes the socket on any error, so the NOSCRIPT an EVALSHA gets
+    before redis-py loads the script kills that pooled connection
+    """
+
+    def setup(self):
+        super().setup()
+        read_response = self.current_client.read_response
+
+        def read_reply(*args, **kwargs):
+            try:
+                return read_response(*args, **kwargs)
+            except redis.ResponseError as e:
+                return e
+
+        self.current_client.read_response = read_reply
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server = TcpFakeServer((args.host, args.port), server_type="redis")
+    server.RequestHandlerClass = RequestHandler
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Sends signed Stripe webhook events to the API, as Stripe would after a checkout"""
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+
+class FakeStripe:
+    def __init__(self, session, webhook_secret: str, duplicate_rate: float = 0.0):
+        self.session = session  # benchmarks.workload.Session
+        self.webhook_secret = webhook_secret
+        # Stripe redelivers events it thinks were not received
+        self.duplicate_rate = duplicate_rate
+
+    def _signature(self, body: str) -> str:
+        timestamp = int(time.time())
+        digest = hmac.new(self.webhook_secret.encode(), f"{timestamp}.{body}".encode(), hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={digest}"
+
+    async def send(self, event_type: str, obj: dict):
+        event = {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "data": {"object": obj},
+        }
+        body = json.dumps(event)
+        headers = {"Stripe-Signature": self._signature(body), "Content-Type": "application/json"}
+        response = await self.session.request("POST", "/webhook/stripe", content=body, headers=headers)
+        if random.random() < self.duplicate_rate:
+            await self.session.request("POST", "/webhook/stripe", name="POST /webhook/stripe (redelivery)", content=body, headers=headers)
+        return response
+
+    async def upgrade(self, user_id: int):
+        """checkout.session.completed for a new Pro subscription"""
+        subscription_id = f"sub_{uuid.uuid4().hex[:14]}"
+        return await self.send("checkout.session.completed", {
+            "id": f"cs_{uuid.uuid4().hex[:14]}",
+            "object": "checkout.session",
+            "customer": f"cus_{user_id}",
+            "subscription": subscription_id,
+            "metadata": {"user_id": str(user_id)},
+        })
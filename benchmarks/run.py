@@ -0,0 +1,231 @@
+"""
+Load test the API with local stand-ins for Redis, Gemini and Stripe
+
+    python -m benchmarks.run --concurrency 20 --duration 30 --out benchmarks/results/baseline.json
+    python -m benchmarks.run --compare benchmarks/results/baseline.json
+
+Starts uvicorn and the workers as separate processes against SQLite (or
+--database-url), a fakeredis TCP server (or --redis-url) and an in-process
+fake Gemini, drives virtual users through signup/OTP login, a Stripe
+upgrade, chatroom creation, messages and polling, then prints p50/p95/p99
+per endpoint and writes the report as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+from benchmarks.fake_gemini import FakeGemini
+from benchmarks.workload import WorkloadConfig, run_workload
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+def wait_for_api(base_url: str, processes: list, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args[:4]} exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API not healthy after {timeout}s")
+
+def build_env(args, redis_url: str, gemini: FakeGemini, workdir: str) -> dict:
+    redis_base = redis_url.rsplit("/", 1)[0] if redis_url.count("/") > 2 else redis_url
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url or f"sqlite:///{workdir}/benchmark.db",
+        REDIS_URL=f"{redis_base}/0",
+        CELERY_BROKER_URL=f"{redis_base}/1",
+        CELERY_RESULT_BACKEND=f"{redis_base}/2",
+        JWT_SECRET="benchmark-secret",
+        STRIPE_SECRET_KEY="sk_test_benchmark",
+        STRIPE_WEBHOOK_SECRET=args.webhook_secret,
+        GEMINI_API_KEY="benchmark",
+        GEMINI_API_URL=gemini.url,
+        PYTHONPATH=str(ROOT),
+    )
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+def start_services(args, env: dict, api_port: int) -> list:
+    quiet = {"cwd": ROOT, "env": env, "stdout": subprocess.DEVNULL if not args.verbose else None, "stderr": None if args.verbose else subprocess.DEVNULL}
+    processes = [subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(api_port),
+        "--workers", str(args.api_workers), "--log-level", "warning",
+    ], **quiet)]
+    if args.worker == "celery":
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "celery", "-A", "app.workers.tasks", "worker", "--loglevel", "warning",
+            "--pool", "threads", "--concurrency", str(args.worker_concurrency), "-Q", "celery,gemini_pro,gemini_basic",
+        ], **quiet))
+    else:
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "celery", "-A", "app.workers.tasks", "worker", "--loglevel", "warning",
+            "--pool", "threads", "--concurrency", "8", "-Q", "celery",
+        ], **quiet))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "app.workers.async_worker"],
+            **dict(quiet, env=dict(env, ASYNC_WORKER_CONCURRENCY=str(args.worker_concurrency)))
+        ))
+    return processes
+
+def stop(processes: list):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def server_stats(base_url: str) -> dict:
+    try:
+        return httpx.get(f"{base_url}/health/stats", timeout=5.0).json()
+    except (httpx.HTTPError, ValueError):
+        return {}
+
+def print_report(report: dict):
+    print(f"\n{report['requests']} requests in {report['duration_s']:.1f}s, {report['throughput']:.1f} req/s\n")
+    header = f"{'endpoint':<42}{'count':>7}{'err':>5}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, e in report["endpoints"].items():
+        print(f"{name:<42}{e['count']:>7}{e['errors']:>5}{e['throughput']:>8.1f}"
+              f"{e['p50_ms']:>9.1f}{e['p95_ms']:>9.1f}{e['p99_ms']:>9.1f}{e['max_ms']:>9.1f}")
+        other = {s: n for s, n in e["statuses"].items() if s != "200"}
+        if other:
+            print(f"{'':<4}statuses: {other}")
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Endpoints whose p95 (or overall throughput) got worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, base in baseline["endpoints"].items():
+        current = report["endpoints"].get(name)
+        if current is None:
+            continue
+        # Ignore a few ms of noise on fast endpoints
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance) and current["p95_ms"] - base["p95_ms"] > 5:
+            regressions.append(f"{name}: p95 {base['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']:.1f} -> {report['throughput']:.1f} req/s")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="sync SQLAlchemy URL, e.g. postgresql://... (default: a fresh SQLite file)")
+    parser.add_argument("--redis-url", help="a real Redis, e.g. redis://localhost:6379 (default: fakeredis over TCP)")
+    parser.add_argument("--worker", choices=["celery", "async"], default="celery", help="Celery thread pool or app.workers.async_worker")
+    parser.add_argument("--worker-concurrency", type=int, default=32)
+    parser.add_argument("--api-workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=20, help="virtual users at once")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to keep starting new users")
+    parser.add_argument("--users", type=int, help="total users instead of --duration")
+    parser.add_argument("--messages", type=int, default=3, help="messages per user")
+    parser.add_argument("--pro-ratio", type=float, default=0.5)
+    parser.add_argument("--stream-ratio", type=float, default=0.1)
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="mean seconds per fake Gemini call")
+    parser.add_argument("--gemini-jitter", type=float, default=0.2)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="share of calls answered with a 503")
+    parser.add_argument("--stripe-duplicate-rate", type=float, default=0.1, help="share of webhooks delivered twice")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra settings for the app, e.g. BCRYPT_ROUNDS=10")
+    parser.add_argument("--out", default=str(ROOT / "benchmarks" / "results" / "latest.json"))
+    parser.add_argument("--compare", metavar="BASELINE", help="fail if p95 or throughput regressed against this report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--webhook-secret", default="whsec_benchmark")
+    parser.add_argument("--verbose", action="store_true", help="show service output")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    config = WorkloadConfig(
+        concurrency=args.concurrency, duration=args.duration, users=args.users, messages=args.messages,
+        pro_ratio=args.pro_ratio, stream_ratio=args.stream_ratio, poll_interval=args.poll_interval,
+        stripe_duplicate_rate=args.stripe_duplicate_rate, webhook_secret=args.webhook_secret,
+    )
+    gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate).start()
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="gemini-bench-") as workdir:
+        try:
+            redis_url = args.redis_url
+            if redis_url is None:
+                redis_port = free_port()
+                processes.append(subprocess.Popen(
+                    [sys.executable, "-m", "benchmarks.fake_redis", "--port", str(redis_port)], cwd=ROOT
+                ))
+                wait_for_port(redis_port)
+                redis_url = f"redis://127.0.0.1:{redis_port}"
+
+            api_port = free_port()
+            base_url = f"http://127.0.0.1:{api_port}"
+            processes += start_services(args, build_env(args, redis_url, gemini, workdir), api_port)
+            wait_for_api(base_url, processes)
+
+            recorder = asyncio.run(run_workload(base_url, config))
+            report = recorder.report()
+            report["server"] = server_stats(base_url)
+        finally:
+            stop(processes)
+
+    report["gemini_calls"] = gemini.calls
+    report["run"] = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": "postgres" if args.database_url and "postgres" in args.database_url else "sqlite",
+        "redis": "redis" if args.redis_url else "fakeredis",
+        "worker": args.worker,
+        "worker_concurrency": args.worker_concurrency,
+        "api_workers": args.api_workers,
+        "gemini_latency": args.gemini_latency,
+        "workload": asdict(config),
+    }
+    print_report(report)
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2, sort_keys=True))
+    print(f"\nreport written to {out}")
+
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if regressions:
+            print(f"\nregressions against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nno regressions against {args.compare}")
+
+if __name__ == "__main__":
+    main()
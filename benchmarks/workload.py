@@ -0,0 +1,202 @@
+"""Virtual users driving a mixed workload against the API, and latency bookkeeping"""
+import asyncio
+import itertools
+import math
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+import httpx
+from benchmarks.fake_stripe import FakeStripe
+
+@dataclass
+class WorkloadConfig:
+    concurrency: int = 20  # virtual users active at once
+    duration: float = 30.0  # seconds; new users stop starting after this
+    users: Optional[int] = None  # stop after this many users instead
+    messages: int = 3  # messages each user sends
+    pro_ratio: float = 0.5  # users upgraded through a Stripe webhook before chatting
+    stream_ratio: float = 0.1  # messages sent to the streaming endpoint
+    poll_interval: float = 0.25  # seconds between GET /chatroom/{id} while waiting for a reply
+    reply_timeout: float = 30.0
+    stripe_duplicate_rate: float = 0.1
+    webhook_secret: str = "whsec_benchmark"
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    # Multiply first: q / 100 * n can land just above an integer (0.07 * 100)
+    rank = max(math.ceil(q * len(values) / 100) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+class Recorder:
+    """Latency samples and status codes per endpoint"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.derived = set()  # timings spanning several requests, not counted as requests
+        self.started = time.monotonic()
+        self.finished = None
+
+    def add(self, name: str, seconds: float, status, derived: bool = False):
+        self.samples[name].append(seconds)
+        self.statuses[name][str(status)] += 1
+        if derived:
+            self.derived.add(name)
+
+    def report(self) -> dict:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        endpoints = {}
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            statuses = self.statuses[name]
+            errors = sum(n for status, n in statuses.items() if not status.isdigit() or int(status) >= 500)
+            endpoints[name] = {
+                "count": len(values),
+                "errors": errors,
+                "statuses": dict(statuses),
+                "throughput": len(values) / elapsed if elapsed else 0.0,
+                "mean_ms": sum(values) / len(values) * 1000,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        requests = sum(e["count"] for name, e in endpoints.items() if name not in self.derived)
+        return {
+            "duration_s": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "endpoints": endpoints,
+        }
+
+class Session:
+    """httpx client that records every request under its route template"""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+
+    async def request(self, method: str, path: str, name: Optional[str] = None, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.add(name or f"{method} {path}", time.perf_counter() - start, type(e).__name__)
+            return None
+        self.recorder.add(name or f"{method} {path}", time.perf_counter() - start, response.status_code)
+        return response
+
+class VirtualUser:
+    """Signs up, logs in with an OTP, maybe goes Pro, then chats in one chatroom"""
+
+    _numbers = itertools.count(1)
+
+    def __init__(self, session: Session, stripe: FakeStripe, config: WorkloadConfig):
+        self.session = session
+        self.stripe = stripe
+        self.config = config
+        self.mobile = f"+1555{uuid.uuid4().int % 10**7:07d}{next(self._numbers)}"
+        self.headers = {}
+
+    async def run(self):
+        if not await self.login():
+            return
+        me = await self.session.request("GET", "/user/me", headers=self.headers)
+        if me is not None and me.status_code == 200 and random.random() < self.config.pro_ratio:
+            await self.stripe.upgrade(me.json()["id"])
+
+        room = await self.session.request("POST", "/chatroom/", json={"name": "benchmark"}, headers=self.headers)
+        if room is None or room.status_code != 200:
+            return
+        chatroom_id = room.json()["id"]
+        await self.session.request("GET", "/chatroom/", headers=self.headers)
+
+        for i in range(self.config.messages):
+            content = f"Question {i} from {self.mobile}: explain event loops briefly"
+            if random.random() < self.config.stream_ratio:
+                await self.stream(chatroom_id, content)
+            else:
+                await self.send(chatroom_id, content)
+        await self.session.request("GET", "/user/usage", headers=self.headers)
+
+    async def login(self) -> bool:
+        credentials = {"mobile_number": self.mobile, "password": "benchmark-password"}
+        signup = await self.session.request("POST", "/auth/signup", json=credentials)
+        if signup is None or signup.status_code != 200:
+            return False
+        sent = await self.session.request("POST", "/auth/send-otp", json={"mobile_number": self.mobile})
+        if sent is None or sent.status_code != 200:
+            return False
+        verified = await self.session.request(
+            "POST", "/auth/verify-otp", json={"mobile_number": self.mobile, "otp": sent.json()["otp"]}
+        )
+        if verified is None or verified.status_code != 200:
+            return False
+        self.headers = {"Authorization": f"Bearer {verified.json()['access_token']}"}
+        return True
+
+    async def send(self, chatroom_id: int, content: str):
+        sent_at = time.perf_counter()
+        headers = dict(self.headers, **{"Idempotency-Key": uuid.uuid4().hex})
+        response = await self.session.request(
+            "POST", f"/chatroom/{chatroom_id}/message", name="POST /chatroom/{id}/message",
+            json={"content": content}, headers=headers
+        )
+        if response is None or response.status_code != 200:
+            return
+        message_id = response.json()["message_id"]
+
+        # Poll the chatroom like a client without a WebSocket until the reply shows up
+        deadline = sent_at + self.config.reply_timeout
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(self.config.poll_interval)
+            detail = await self.session.request(
+                "GET", f"/chatroom/{chatroom_id}", name="GET /chatroom/{id}",
+                params={"limit": 20}, headers=self.headers
+            )
+            if detail is None or detail.status_code != 200:
+                continue
+            if any(m["sender"] == "bot" and m["id"] > message_id for m in detail.json()["messages"]):
+                self.session.recorder.add("reply visible (send -> poll)", time.perf_counter() - sent_at, 200, derived=True)
+                return
+        self.session.recorder.add("reply visible (send -> poll)", time.perf_counter() - sent_at, "timeout", derived=True)
+
+    async def stream(self, chatroom_id: int, content: str):
+        start = time.perf_counter()
+        first_token = None
+        status = "error"
+        try:
+            async with self.session.client.stream(
+                "POST", f"/chatroom/{chatroom_id}/message/stream", json={"content": content}, headers=self.headers
+            ) as response:
+                status = response.status_code
+                async for line in response.aiter_lines():
+                    if first_token is None and line.startswith("event: token"):
+                        first_token = time.perf_counter() - start
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.session.recorder.add("POST /chatroom/{id}/message/stream", time.perf_counter() - start, status)
+        if first_token is not None:
+            self.session.recorder.add("stream first token", first_token, status, derived=True)
+
+async def run_workload(base_url: str, config: WorkloadConfig) -> Recorder:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=config.concurrency * 2, max_keepalive_connections=config.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0, limits=limits) as client:
+        session = Session(client, recorder)
+        stripe = FakeStripe(session, config.webhook_secret, config.stripe_duplicate_rate)
+        deadline = time.monotonic() + config.duration
+        started = itertools.count()
+
+        async def runner():
+            while time.monotonic() < deadline and (config.users is None or next(started) < config.users):
+                await VirtualUser(session, stripe, config).run()
+
+        await asyncio.gather(*(runner() for _ in range(config.concurrency)))
+    recorder.finished = time.monotonic()
+    return recorder